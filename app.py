@@ -1,37 +1,143 @@
 import os
+import re
+import logging
+from datetime import date
 from flask import (
   Flask,
+  Response,
   request,
   abort,
   jsonify
 )
-from flask_sqlalchemy import SQLAlchemy
-from flask_cors import CORS
+from sqlalchemy import or_
 # from flask_migrate import Migrate
 
-# Stuff to render my README.md on the home page
-import markdown
-import markdown.extensions.fenced_code  # Supports GitHub's backtick (```code```) blocks
-import markdown.extensions.codehilite   # Code highlighting: Python, JSON
-import markdown.extensions.tables       # Format tables better in HTML
-import markdown.extensions.sane_lists   # Make bulleted list formatting in HTML better
-from pygments.formatters import HtmlFormatter
+# NOTE: markdown, pygments, flask_cors and jose are heavy to import, so they are
+# imported where they're first used instead of up here.  Keeps cold start fast.
 
 # My modules
-from models import setup_db, Company, Policy
-from auth import AuthError, requires_auth
+from models import (
+  db, setup_db, unit_of_work, record_change, Company, Policy,
+  company_list, changes_since
+)
+from auth import AuthError, requires_auth, init_auth
+from logs import init_logging, init_stats_log
+from ratelimit import init_rate_limits
+from singleflight import SingleFlight, SingleFlightTimeout
+from changes import ChangeFeed
+from tenants import CatalogStore, tenant_from_claims, requested_tenant, render_policy
+from replicas import reads_from_replica, read_target
+from profiler import init_profiling
+from render import FORMATS
+from policy_template import TemplateError
+
+log = logging.getLogger(__name__)
+
+# A GET /changes cursor is a change id, at most 18 digits so it fits a BIGINT
+CURSOR = re.compile(r'[0-9]{1,18}')
+
+
+def load_config():
+    '''
+    load_config()
+    Default configuration, read from the environment (see setup.sh)
+    Anything passed to create_app(test_config) overrides these
+    '''
+    return {
+        "DATABASE_URL": os.getenv('DATABASE_URL'),
+        "AUTH0_DOMAIN": os.getenv('AUTH0_DOMAIN'),     # 'roboterms.us.auth0.com'
+        "ALGORITHMS": os.getenv('ALGORITHMS'),         # 'RS256'
+        "API_AUDIENCE": os.getenv('API_AUDIENCE'),     # 'roboterms-api'
+        "CORS_ORIGINS": os.getenv('CORS_ORIGINS', '*'),
+        # Rate limiting, see ratelimit.py
+        "RATELIMIT_ENABLED": os.getenv('RATELIMIT_ENABLED', '1') == '1',
+        "RATELIMIT_DEFAULT": os.getenv('RATELIMIT_DEFAULT', '120/minute'),
+        "RATELIMITS": {
+            "get_companies": os.getenv('RATELIMIT_COMPANIES', '30/minute'),
+        },
+        "RATELIMIT_KEY": os.getenv('RATELIMIT_KEY', 'ip'),
+        # Heroku (which sets DYNO) always sits behind its router, so trust it there
+        "RATELIMIT_TRUST_PROXY": os.getenv('RATELIMIT_TRUST_PROXY', '1' if os.getenv('DYNO') else '0') == '1',
+        "RATELIMIT_STORAGE_URL": os.getenv('RATELIMIT_STORAGE_URL', 'memory://'),
+        # Seconds a coalesced read waits for the in-flight one before giving up
+        "SINGLEFLIGHT_TIMEOUT": float(os.getenv('SINGLEFLIGHT_TIMEOUT', '10')),
+        # Most companies one POST /company/bulk can create
+        "BULK_LIMIT": int(os.getenv('BULK_LIMIT', '1000')),
+        # Logging, see logs.py
+        "LOG_LEVEL": os.getenv('LOG_LEVEL', 'INFO'),
+        "LOG_JSON": os.getenv('LOG_JSON', '1') == '1',
+        "LOG_SAMPLE_RATE": float(os.getenv('LOG_SAMPLE_RATE', '0.1')),
+        "SLOW_REQUEST_MS": float(os.getenv('SLOW_REQUEST_MS', '500')),
+        "SLOW_QUERY_MS": float(os.getenv('SLOW_QUERY_MS', '100')),
+        "STATS_LOG_INTERVAL": float(os.getenv('STATS_LOG_INTERVAL', '60')),
+        # Read replicas, see replicas.py
+        "DATABASE_REPLICA_URLS": os.getenv('DATABASE_REPLICA_URLS', ''),
+        "REPLICA_HEALTH_INTERVAL": float(os.getenv('REPLICA_HEALTH_INTERVAL', '30')),
+        "REPLICA_STICKY_SECONDS": float(os.getenv('REPLICA_STICKY_SECONDS', '5')),
+        # Tenants and policy catalogs, see tenants.py
+        "TENANT_CLAIM": os.getenv('TENANT_CLAIM', 'org_id'),
+        "CATALOG_MAX_AGE": float(os.getenv('CATALOG_MAX_AGE', '10')),
+        "CATALOG_MAX_TENANTS": int(os.getenv('CATALOG_MAX_TENANTS', '1000')),
+        # Change feed, see GET /changes
+        "CHANGES_PAGE_SIZE": int(os.getenv('CHANGES_PAGE_SIZE', '100')),
+        # Longest ?wait=, well under gunicorn's 30 second worker timeout
+        "CHANGES_MAX_WAIT": float(os.getenv('CHANGES_MAX_WAIT', '20')),
+        "CHANGES_POLL_INTERVAL": float(os.getenv('CHANGES_POLL_INTERVAL', '1')),
+        # Profiling, see profiler.py.  Off unless asked for.
+        "PROFILING_ENABLED": os.getenv('PROFILING_ENABLED', '0') == '1',
+        "PROFILE_MAX_SECONDS": float(os.getenv('PROFILE_MAX_SECONDS', '60')),
+    }
+
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
-    CORS(app)   # Allow all origins
+    app.config.from_mapping(load_config())
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+
+    from flask_cors import CORS
+    CORS(app, origins=app.config["CORS_ORIGINS"])   # Allow all origins by default
+
+    # Request ids and timing first, so every request gets them
+    init_logging(app)
+
+    # Rate limiting runs before anything else touches the request
+    init_rate_limits(app)
 
     # Set up the database first
     setup_db(app)
 
+    # One token verifier per app, it keeps Auth0's public keys between requests
+    init_auth(app)
+
+    # Shares in-flight reads between concurrent identical requests
+    reads = SingleFlight(timeout=app.config["SINGLEFLIGHT_TIMEOUT"])
+    app.extensions['singleflight'] = reads
+    init_stats_log(app, {'singleflight': reads.stats})
+
+    # Wakes up GET /changes long polls when this worker commits a change
+    feed = ChangeFeed(poll_interval=app.config["CHANGES_POLL_INTERVAL"])
+    app.extensions['changes'] = feed
+
+    # In-memory snapshot of each tenant's policies, renders never query them
+    catalogs = CatalogStore(max_age=app.config["CATALOG_MAX_AGE"], max_tenants=app.config["CATALOG_MAX_TENANTS"])
+    app.extensions['catalogs'] = catalogs
+
+    # GET /profile and the X-Profile header, only if PROFILING_ENABLED
+    init_profiling(app)
+
     @app.route('/', methods=['GET'])
     def index():
         # https://dev.to/mrprofessor/rendering-markdown-from-flask-1l41
+        # Stuff to render my README.md on the home page, loaded on first visit
+        import markdown
+        import markdown.extensions.fenced_code  # Supports GitHub's backtick (```code```) blocks
+        import markdown.extensions.codehilite   # Code highlighting: Python, JSON
+        import markdown.extensions.tables       # Format tables better in HTML
+        import markdown.extensions.sane_lists   # Make bulleted list formatting in HTML better
+        from pygments.formatters import HtmlFormatter
+
         with open("README.md", "r") as readme:
             md_template_string = markdown.markdown(
                 readme.read(), extensions=["fenced_code", "codehilite", "tables", "sane_lists"]
@@ -49,54 +155,53 @@ def create_app(test_config=None):
 
 
     @app.route('/companies', methods=['GET'])
+    @reads_from_replica
     def get_companies():
-        company_list = []
-        companies = Company.query.all()
-        for co in companies:
-            company_list.append({
-                "id": co.id,
-                "name": co.name,
-                "website": co.website
-            })
+        tenant_id = requested_tenant()
+
+        # Concurrent identical reads share one query (see singleflight.py), as
+        # long as they'd read from the same place (see replicas.py)
+        companies = reads.do(f'companies:{read_target()}:{tenant_id}', lambda: company_list(tenant_id))
 
         # Build overall response
         data = {
-            "companies": company_list,
+            "companies": companies,
             "success": True
         }
         return jsonify(data)
 
     
     @app.route('/policies', methods=['GET'])
+    @reads_from_replica
     def get_policies():
-        pol_list = []
-        policies = Policy.query.all()
-        for pol in policies:
-            pol_list.append({
-                "id": pol.id,
-                "name": pol.name,
-                "body": pol.body
-            })
+        # Straight from the tenant's catalog snapshot, no query
+        policies = catalogs.get(requested_tenant()).as_list()
         
         data = {
-            "policies": pol_list,
+            "policies": policies,
             "success": True
         }
         return jsonify(data)
     
 
     @app.route('/rendered_policy/<int:company_id>/<int:policy_id>', methods=['GET'])
+    @reads_from_replica
     def get_rendered_policy(company_id, policy_id):
-        company = Company.query.get(company_id)
-        if not company:
-            abort(404)
-            
-        policy = Policy.query.get(policy_id)
-        if not policy:
+        # ?format=html|markdown|text returns the policy as-is, ready to embed.
+        # Default is the policy text inside JSON.
+        fmt = request.args.get('format', 'json')
+        if fmt not in FORMATS:
+            abort(400)
+
+        rendered_policy = reads.do(
+            f'rendered_policy:{read_target()}:{company_id}:{policy_id}:{fmt}',
+            lambda: render_policy(catalogs, company_id, policy_id, fmt)
+        )
+        if rendered_policy is None:
             abort(404)
-            
-        # Fill in the placeholders {COMPANY} and {WEBSITE} with real data
-        rendered_policy = policy.body.format(COMPANY=company.name, WEBSITE=company.website)
+
+        if fmt != 'json':
+            return Response(rendered_policy, mimetype=FORMATS[fmt])
 
         data = {
             "policy": rendered_policy,
@@ -105,55 +210,137 @@ def create_app(test_config=None):
         return jsonify(data)
 
     
-    @app.route('/company', methods=['POST'])
-    @requires_auth(permission='post:company')
-    def add_company(payload):
-        body = request.json
-
+    def new_company(data):
+        '''
+        Builds an (unsaved) Company from a request's JSON, or aborts with 422
+        '''
         # Need to have name and website keys in body
-        if not all([ x in body for x in ['name', 'website'] ]):
+        if not isinstance(data, dict) or not all([ x in data for x in ['name', 'website'] ]):
+            abort(422)
+
+        # Optional details for the policy placeholders, effective_date as YYYY-MM-DD
+        try:
+            effective_date = data.get('effective_date')
+            if effective_date:
+                effective_date = date.fromisoformat(effective_date)
+
+            return Company(
+                name=data['name'].strip(),
+                website=data['website'].strip(),
+                contact_email=data.get('contact_email'),
+                jurisdiction=data.get('jurisdiction'),
+                effective_date=effective_date or None
+            )
+        except (AttributeError, TypeError, ValueError):
+            abort(422)
+
+    def check_duplicates(new_cos, tenant_id):
+        '''
+        Aborts with 422 if any of the new companies' names or websites are taken
+        in the tenant, or repeated among them.  One query however many companies there are.
+        '''
+        names = [co.name for co in new_cos]
+        websites = [co.website for co in new_cos]
+        if len(set(names)) != len(names) or len(set(websites)) != len(websites):
             abort(422)
 
         # Here we want this to return None otherwise another company has that name
         # If you don't handle this way, function works, but unittests catches the 
-        # print statement below in the 'except Exception as e' block and clutters
+        # log line in add_company()'s 'except Exception as e' block and clutters
         # up the unittests output.
-        duplicate_name = Company.query.filter_by(name=body['name'].strip()).one_or_none()
-        if duplicate_name:
-            abort(422)
-        duplicate_website = Company.query.filter_by(website=body['website'].strip()).one_or_none()
-        if duplicate_website:
+        duplicate = Company.live(tenant_id).filter(
+            or_(Company.name.in_(names), Company.website.in_(websites))
+        ).first()
+        if duplicate:
             abort(422)
 
+
+    @app.route('/company', methods=['POST'])
+    @requires_auth(permission='post:company')
+    def add_company(payload):
+        # Companies go in the tenant of whoever creates them
+        tenant_id = tenant_from_claims(payload)
+        new_co = new_company(request.json)
+        new_co.tenant_id = tenant_id
+        check_duplicates([new_co], tenant_id)
+
         try:
-            new_co = Company(name=body['name'].strip(), website=body['website'].strip())
-            new_co.insert()
+            with unit_of_work():
+                new_co.insert()
+                record_change('create', new_co)
         except Exception as e:
-            print(f'Exception in add_company(): {e}')
+            log.warning('Exception in add_company(): %s', e)
             abort(422)  # Syntax is good, can't process for semantic reasons
 
+        # Reads already in flight may have missed this, don't let new ones join them
+        reads.forget()
+        feed.notify()
+
         return jsonify({
             "id": new_co.id,
             "success": True
         })
 
+
+    @app.route('/company/bulk', methods=['POST'])
+    @requires_auth(permission='post:company')
+    def add_companies(payload):
+        body = request.json
+        companies = body.get('companies') if isinstance(body, dict) else None
+
+        # Between 1 and BULK_LIMIT companies
+        if not isinstance(companies, list) or not 0 < len(companies) <= app.config["BULK_LIMIT"]:
+            abort(422)
+
+        tenant_id = tenant_from_claims(payload)
+        new_cos = [new_company(data) for data in companies]
+        for new_co in new_cos:
+            new_co.tenant_id = tenant_id
+        check_duplicates(new_cos, tenant_id)
+
+        # All or nothing, in one transaction instead of one per company
+        try:
+            with unit_of_work():
+                for new_co in new_cos:
+                    new_co.insert()
+                record_change('create', *new_cos)
+                ids = [new_co.id for new_co in new_cos]
+        except Exception as e:
+            log.warning('Exception in add_companies(): %s', e)
+            abort(422)
+
+        reads.forget()
+        feed.notify()
+
+        return jsonify({
+            "ids": ids,
+            "success": True
+        })
+
     
     @app.route('/company/<int:company_id>', methods=['DELETE'])
     @requires_auth(permission='delete:company')
     def delete_company(payload, company_id):
-        # Get the company to delete
-        goner_co = Company.query.get(company_id)
+        # Get the company to delete (already deleted ones, and other tenants', are a 404 too)
+        goner_co = Company.get_live(company_id, tenant_from_claims(payload))
         if not goner_co:
             abort(404)
         
-        id = goner_co.id    # Will lose this after delete
+        id = goner_co.id
 
+        # Only marks it deleted, so this returns right away.  The row and anything
+        # hanging off it are removed later by: python manage.py purge
         try:
-            goner_co.delete()
+            with unit_of_work():
+                goner_co.delete()
+                record_change('delete', goner_co)
         except Exception as e:
-            print(f'Exception in delete_company(): {e}')
+            log.warning('Exception in delete_company(): %s', e)
             abort(422)
 
+        reads.forget()
+        feed.notify()
+
         return jsonify({
             "id": id,
             "success": True
@@ -163,8 +350,9 @@ def create_app(test_config=None):
     @app.route('/policy/<int:policy_id>', methods=['PATCH'])
     @requires_auth(permission='edit:policy')
     def edit_policy(payload, policy_id):
-        # Get the policy to edit
-        policy = Policy.query.get(policy_id)
+        # Get the policy to edit, from the editor's own tenant's catalog
+        tenant_id = tenant_from_claims(payload)
+        policy = Policy.query.filter_by(id=policy_id, tenant_id=tenant_id).one_or_none()
         if not policy:
             abort(404)
         
@@ -178,18 +366,63 @@ def create_app(test_config=None):
         if 'name' in body:
             policy.name = body['name']
         if 'body' in body:
-            policy.body = body['body']  # whoah
+            # Compiled as a template right here, so a broken one is a 422 now
+            # rather than a 500 for everybody who renders it later
+            try:
+                policy.body = body['body']  # whoah
+            except TemplateError as e:
+                log.warning('Exception in edit_policy(): %s', e)
+                abort(422)
         
         try:
-            policy.update()
+            with unit_of_work():
+                policy.update()
+                record_change('update', policy)
         except Exception as e:
-            print(f'Exception in edit_policy(): {e}')
+            log.warning('Exception in edit_policy(): %s', e)
             abort(422)
+
+        # Swap in the new catalog, renders in this worker see the edit right away
+        catalogs.reload(tenant_id)
+        reads.forget()
+        feed.notify()
         
         return jsonify({
             "success": True
         })
 
+
+
+    @app.route('/changes', methods=['GET'])
+    def get_changes():
+        # ?since=<cursor from the last response>, no since = from the beginning
+        # ?wait=<seconds> waits for changes if there aren't any yet (long poll)
+        tenant_id = requested_tenant()
+        since = request.args.get('since', '0')
+        try:
+            limit = int(request.args.get('limit', app.config["CHANGES_PAGE_SIZE"]))
+            wait = float(request.args.get('wait', 0))
+        except ValueError:
+            abort(400)
+        # ASCII digits only, str.isdigit() takes any Unicode digit
+        if not CURSOR.fullmatch(since) or not 0 < limit <= 1000 or not 0 <= wait <= app.config["CHANGES_MAX_WAIT"]:
+            abort(400)
+        cursor = int(since)
+
+        def fetch():
+            changes = changes_since(cursor, limit, tenant_id)
+            db.session.close()  # Don't hang on to a connection while waiting
+            return changes
+
+        changes = feed.wait(fetch, wait) if wait else fetch()
+
+        return jsonify({
+            "changes": changes,
+            "cursor": changes[-1]["cursor"] if changes else str(cursor),
+            "has_more": len(changes) == limit,
+            "success": True
+        })
+
     
     ## Error Handling.  Returns tuple of JSON data and integer status code
 
@@ -251,6 +484,15 @@ def create_app(test_config=None):
             "message": "method not allowed"
             }), 405
 
+    @app.errorhandler(409)
+    def conflict(error):
+        '''Request conflicts with something already going on (e.g. a profile already running)'''
+        return jsonify({
+            "success": False, 
+            "error": 409,
+            "message": "conflict"
+            }), 409
+
     @app.errorhandler(422)
     def unprocessable(error):
         '''The request was well-formed but unable to be followed due to semantic errors'''
@@ -260,6 +502,29 @@ def create_app(test_config=None):
             "message": "unprocessable"
             }), 422
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        '''Client has used up its rate limit, try again after the Retry-After header'''
+        return jsonify({
+            "success": False, 
+            "error": 429,
+            "message": "too many requests"
+            }), 429
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        '''Server is too busy to answer right now (e.g. timed out waiting on a shared read)'''
+        return jsonify({
+            "success": False, 
+            "error": 503,
+            "message": "service unavailable"
+            }), 503
+
+    @app.errorhandler(SingleFlightTimeout)
+    def singleflight_timeout(excpt):
+        log.warning('Exception in read: %s', excpt)
+        return service_unavailable(excpt)
+
     @app.errorhandler(500)
     def server_error(error):
         '''Catch-all for server error on our end'''
@@ -272,8 +537,17 @@ def create_app(test_config=None):
 
     return app
 
-app = create_app()
+
+def __getattr__(name):
+    # Build the module-level app on first access (gunicorn app:app, manage.py)
+    # instead of at import, so importing create_app stays cheap.
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 if __name__ == '__main__':
     # APP.run(host='0.0.0.0', port=8080, debug=True)
-    app.run()
\ No newline at end of file
+    create_app().run()
\ No newline at end of file
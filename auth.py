@@ -1,17 +1,248 @@
 import os
 import json
-from flask import request, _request_ctx_stack, abort
+import time
+import logging
+import threading
+from flask import request, _request_ctx_stack, abort, current_app, g
+from werkzeug.exceptions import HTTPException
 from functools import wraps
-from jose import jwt
 from urllib.request import urlopen
 
-# Ensure environment variables are set
-if not all([os.getenv('AUTH0_DOMAIN'), os.getenv('ALGORITHMS'), os.getenv('API_AUDIENCE')]):
-    raise RuntimeError("Environment variables are not set, did you source setup.sh?")
+log = logging.getLogger(__name__)
 
-AUTH0_DOMAIN = os.getenv('AUTH0_DOMAIN')    # 'roboterms.us.auth0.com'
-ALGORITHMS = [os.getenv('ALGORITHMS')]      # ['RS256'], a list, but just one here
-API_AUDIENCE = os.getenv('API_AUDIENCE')    # 'roboterms-api'
+# NOTE: jose (and pycryptodome under it) is imported inside JWTVerifier,
+# so public routes and cold start never pay for it.
+
+# Longest Authorization header we'll look at.  Real tokens are ~1KB, and
+# anything longer is rejected before it's split or decoded.
+MAX_AUTH_HEADER = 8192
+
+
+# Issuer of tokens made with manage.py token (when there's no AUTH0_DOMAIN)
+LOCAL_ISSUER = 'roboterms-local'
+
+
+def get_auth_config(config=None):
+    '''
+    Returns (AUTH0_DOMAIN, ALGORITHMS, API_AUDIENCE) from the app config set up
+    in create_app(), falling back to the environment
+    '''
+    config = current_app.config if config is None else config
+    auth0_domain = config.get('AUTH0_DOMAIN') or os.getenv('AUTH0_DOMAIN')    # 'roboterms.us.auth0.com'
+    algorithms = config.get('ALGORITHMS') or os.getenv('ALGORITHMS')          # 'RS256'
+    api_audience = config.get('API_AUDIENCE') or os.getenv('API_AUDIENCE')    # 'roboterms-api'
+
+    # Ensure the settings exist
+    if not all([auth0_domain, algorithms, api_audience]):
+        raise RuntimeError("Environment variables are not set, did you source setup.sh?")
+
+    return auth0_domain, [algorithms], api_audience    # ALGORITHMS is a list, but just one here
+
+
+## Key providers
+# Where a JWTVerifier gets its public keys.  Anything with a fetch_jwks()
+# method returning a JWKS dict ({"keys": [...]}) will do.
+
+class Auth0KeyProvider:
+    '''Auth0's public keys, from https://<AUTH0_DOMAIN>/.well-known/jwks.json'''
+
+    def __init__(self, auth0_domain):
+        self.auth0_domain = auth0_domain
+
+    def fetch_jwks(self):
+        '''
+        NOTE: urlopen has a common certificate error described here: https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
+        '''
+        with urlopen(f'https://{self.auth0_domain}/.well-known/jwks.json', timeout=10) as response:
+            return json.loads(response.read())
+
+
+class JWKSFileKeyProvider:
+    '''Public keys from a local JWKS file, e.g. the one made by manage.py keygen'''
+
+    def __init__(self, path):
+        self.path = path
+
+    def fetch_jwks(self):
+        with open(self.path, encoding='utf-8') as jwks_file:
+            return json.load(jwks_file)
+
+
+class JWTVerifier:
+    '''
+    Verifies RS256 tokens.  One is made per app in init_auth(), and it keeps the
+    parsed RSA public keys by kid, so verifying a token is just the signature and
+    claims checks: no JWKS download, and no rebuilding the key from its n/e numbers.
+    EXAMPLE
+        verifier = JWTVerifier(Auth0KeyProvider('roboterms.us.auth0.com'), ['RS256'],
+                               'roboterms-api', 'https://roboterms.us.auth0.com/')
+        payload = verifier.verify(token)
+    '''
+
+    def __init__(self, key_provider, algorithms, api_audience, issuer, jwks_ttl=3600, refresh_interval=60):
+        self.key_provider = key_provider
+        self.algorithms = algorithms
+        self.api_audience = api_audience
+        self.issuer = issuer
+        self.jwks_ttl = jwks_ttl                    # Seconds before the keys are downloaded again
+        self.refresh_interval = refresh_interval    # Least seconds between downloads for an unknown kid
+        self._keys = {}
+        self._fetched_at = None
+        self._lock = threading.Lock()
+
+    def load_keys(self):
+        '''Downloads the JWKS and parses every RSA key in it, once'''
+        from jose import jwk
+
+        # Example of what's in the Auth0 well-known public key info:
+        # {"keys": [{"kty": "RSA", "kid": "Jyh1-4Bv8DT-dLVtnbI58", "use": "sig", "n": "...", "e": "AQAB", ...}]}
+        keys = {}
+        for key in self.key_provider.fetch_jwks()['keys']:
+            if key.get('kty') != 'RSA' or 'kid' not in key:
+                continue
+            try:
+                keys[key['kid']] = jwk.construct(key, key.get('alg', self.algorithms[0])).prepared_key
+            except Exception as e:
+                log.warning('Exception in load_keys(), skipping key %s: %s', key.get('kid'), e)
+
+        # Swapped in whole, so other threads never see a half-built dict
+        self._keys = keys
+        self._fetched_at = time.monotonic()
+
+    def get_key(self, kid):
+        '''
+        Returns the parsed public key for kid, or None.  Downloads the keys again
+        when they're older than jwks_ttl, or when the kid is unknown (Auth0 may have
+        rotated its keys), but at most every refresh_interval seconds for that.
+        '''
+        key = self._keys.get(kid)
+        if key is not None and time.monotonic() - self._fetched_at < self.jwks_ttl:
+            return key
+
+        with self._lock:    # One download at a time, the others wait for it
+            age = float('inf') if self._fetched_at is None else time.monotonic() - self._fetched_at
+            if age >= self.jwks_ttl or (kid not in self._keys and age >= self.refresh_interval):
+                try:
+                    self.load_keys()
+                except Exception as e:
+                    if not self._keys:
+                        raise
+                    # Keep the keys we have and try again in refresh_interval
+                    log.warning('Exception in get_key(), keeping cached keys: %s', e)
+                    self._fetched_at = time.monotonic() - self.jwks_ttl + self.refresh_interval
+        return self._keys.get(kid)
+
+    def verify(self, token):
+        '''Same as verify_decode_jwt(token)'''
+        from jose import jwt
+
+        try:
+            unverified_header = jwt.get_unverified_header(token)    # Gets the header, but hasn't verified anything (don't trust it!)
+        except Exception as e:
+            log.warning('Exception in verify_decode_jwt(): %s', e)
+            abort(400)
+
+        # We need to find the RSA public key id ("kid") among the provider's public keys
+        # Example of a header for one of our tokens:
+        # unverified_header = {
+        #     "alg": "RS256",
+        #     "typ": "JWT",
+        #     "kid": "Jyh1-4Bv8DT-dLVtnbI58"
+        # }
+        if 'kid' not in unverified_header:
+            raise AuthError({
+                'code': 'invalid_header',
+                'description': 'Authorization malformed.'
+            }, 401)
+
+        rsa_key = self.get_key(unverified_header['kid'])
+        if rsa_key is None:
+            raise AuthError({
+                'code': 'invalid_header',
+                'description': 'Unable to find the appropriate key.'
+            }, 400)
+
+        # Now finally verify the signature
+        try:
+            # Straight from JWT documentation, https://python-jose.readthedocs.io/en/latest/jwt/api.html
+            # jose uses an already parsed key as-is, but only when it's passed
+            # as a mapping of keys (a bare key object would be read as a JWK dict)
+            return jwt.decode(
+                token,
+                {'key': rsa_key},
+                algorithms=self.algorithms,
+                audience=self.api_audience,
+                issuer=self.issuer
+            )
+
+        except jwt.ExpiredSignatureError:
+            raise AuthError({
+                'code': 'token_expired',
+                'description': 'Token expired.'
+            }, 401)
+
+        except jwt.JWTClaimsError:
+            raise AuthError({
+                'code': 'invalid_claims',
+                'description': 'Incorrect claims. Please, check the audience and issuer.'
+            }, 401)
+
+        except Exception:
+            raise AuthError({
+                'code': 'invalid_header',
+                'description': 'Unable to parse authentication token.'
+            }, 400)
+
+
+def make_verifier(config=None):
+    '''
+    Makes a JWTVerifier from the app config, falling back to the environment.
+    Keys come from, in order:
+        AUTH_KEY_PROVIDER   any key provider object (e.g. from create_app(test_config))
+        AUTH_JWKS_FILE      a local JWKS file, for locally minted tokens (see manage.py token)
+        AUTH0_DOMAIN        Auth0, as deployed
+    AUTH_ISSUER overrides the expected "iss" claim.
+    '''
+    config = current_app.config if config is None else config
+
+    def setting(name, default=None):
+        return config.get(name) or os.getenv(name) or default
+
+    provider = config.get('AUTH_KEY_PROVIDER')
+    jwks_file = setting('AUTH_JWKS_FILE')
+    if provider is None and jwks_file:
+        provider = JWKSFileKeyProvider(jwks_file)
+
+    if provider is not None:
+        # Offline, so fill in the settings Auth0 would normally go with
+        return JWTVerifier(provider, [setting('ALGORITHMS', 'RS256')], setting('API_AUDIENCE', 'roboterms-api'),
+                           setting('AUTH_ISSUER', LOCAL_ISSUER))
+
+    auth0_domain, algorithms, api_audience = get_auth_config(config)
+    return JWTVerifier(Auth0KeyProvider(auth0_domain), algorithms, api_audience,
+                       setting('AUTH_ISSUER', 'https://' + auth0_domain + '/'))
+
+
+def init_auth(app):
+    '''
+    init_auth(app)
+    Makes the app's JWTVerifier from app.config (see make_verifier).  Without any
+    auth settings the app still starts, and only authenticated routes fail.
+    '''
+    try:
+        verifier = make_verifier(app.config)
+    except RuntimeError:
+        verifier = None
+    app.extensions['auth'] = verifier
+    return verifier
+
+
+def get_verifier():
+    verifier = current_app.extensions.get('auth')
+    if verifier is None:
+        # Raises if the settings are still missing
+        verifier = current_app.extensions['auth'] = make_verifier()
+    return verifier
 
 # Permissions set up on Auth0 (RBAC)
 # post:company
@@ -30,17 +261,32 @@ class AuthError(Exception):
 
 
 ## Auth Header
+def split_auth_header(header):
+    '''
+    Splits an Authorization header into its parts, "Bearer <token>" -> ['Bearer', '<token>'].
+    Returns None if it's too long to be a real one, so the work is bounded.
+    '''
+    if len(header) > MAX_AUTH_HEADER:
+        return None
+    return header.split()
+
+
 def get_token_auth_header():
-    token = request.headers.get('Authorization', None)
-    if not token:
-        # If no header, .get above returns None
+    # Token should return a list, with first part "Bearer" and second part the actual token
+    parts = split_auth_header(request.headers.get('Authorization', ''))
+    if parts == []:
+        # No header, or nothing but whitespace in it
         raise AuthError({
             'code': 'missing_auth_header',
             'description': 'Missing Authorization header'
         }, 401)
-    
-    # Token should return a list, with first part "Bearer" and second part the actual token
-    parts = token.split()
+
+    # Too long to be a real one, so it wasn't split (see split_auth_header)
+    if parts is None:
+        raise AuthError({
+            'code': 'invalid_auth_header',
+            'description': f'Authorization header is too long (over {MAX_AUTH_HEADER} characters).'
+        }, 401)
 
     # Check first part is bearer
     if parts[0].lower() != 'bearer':
@@ -61,97 +307,35 @@ def get_token_auth_header():
     return token
 
 
+def get_verified_payload():
+    '''
+    Returns the verified payload of the request's bearer token, or None if
+    there's no token or it doesn't verify.  For telling clients apart before
+    auth runs (e.g. rate limiting).  The result is kept on g, so requires_auth
+    doesn't verify the same token twice.
+    '''
+    if '_auth_payload' not in g:
+        try:
+            g._auth_payload = verify_decode_jwt(get_token_auth_header())
+        except (AuthError, HTTPException, RuntimeError):
+            g._auth_payload = None
+    return g._auth_payload
+
+
 def verify_decode_jwt(token):
     '''
     @INPUTS
         token: a json web token (string)
 
-    it should be an Auth0 token with key id (kid)
-    it should verify the token using Auth0 /.well-known/jwks.json
+    it should be an Auth0 (or locally minted) token with key id (kid)
+    it should verify the token using Auth0 /.well-known/jwks.json (or AUTH_JWKS_FILE)
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
 
-    NOTE: urlopen has a common certificate error described here: https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
+    The work is done by the app's JWTVerifier, which caches the public keys
     '''
-    # Get the public keys for RSA from Auth0 here:
-    json_url = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(json_url.read())
-    try:
-        unverified_header = jwt.get_unverified_header(token)    # Gets the header, but hasn't verified anything (don't trust it!)
-    except Exception as e:
-        print(f'Exception in verify_decode_jwt(): {e}')
-        abort(400)
-    
-    # We need to search for the RSA public key id ("kid") that matches the public keys
-    # over at the Auth0.com/well-known/jwks.json link
-    
-    # Example of a header for one of our tokens:
-    # unverified_header = {
-    #     "alg": "RS256",
-    #     "typ": "JWT",
-    #     "kid": "Jyh1-4Bv8DT-dLVtnbI58"
-    # }
-
-    if 'kid' not in unverified_header:
-        raise AuthError({
-            'code': 'invalid_header',
-            'description': 'Authorization malformed.'
-        }, 401)
-
-    # Iterate searching for a match
-    # Example of what's in the Auth0 well-known public key info:
-    
-    rsa_key = {}
-    for key in jwks['keys']:
-
-        # print(f"key kid: {key['kid']}")   # Debugging why rsa_key not found
-
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-            break   # No need to look further
-    
-    # Now finally verify the signature
-    if rsa_key:
-        try:
-            # Straight from JWT documentation, https://python-jose.readthedocs.io/en/latest/jwt/api.html
-            payload = jwt.decode(
-                token,
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
-            )
-            return payload
-
-        except jwt.ExpiredSignatureError:
-            raise AuthError({
-                'code': 'token_expired',
-                'description': 'Token expired.'
-            }, 401)
-
-        except jwt.JWTClaimsError:
-            raise AuthError({
-                'code': 'invalid_claims',
-                'description': 'Incorrect claims. Please, check the audience and issuer.'
-            }, 401)
-
-        except Exception:
-            raise AuthError({
-                'code': 'invalid_header',
-                'description': 'Unable to parse authentication token.'
-            }, 400)
-
-    raise AuthError({
-                'code': 'invalid_header',
-                'description': 'Unable to find the appropriate key.'
-            }, 400)
+    return get_verifier().verify(token)
 
 
 '''
@@ -197,13 +381,14 @@ def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            # print("in requires_auth")
-            token = get_token_auth_header()
-            # print("..got token")
-            payload = verify_decode_jwt(token)
-            # print("....verified token")
+            # Already verified (e.g. by the rate limiter)?  Otherwise verify
+            # it here, which raises the AuthError explaining what's wrong
+            payload = g.get('_auth_payload')
+            if payload is None:
+                token = get_token_auth_header()
+                payload = verify_decode_jwt(token)
             check_permissions(permission, payload)
-            # print("......permissions checked OK")
+            log.debug('Authorized %s for %s', payload.get('sub'), permission)
             return f(payload, *args, **kwargs)
         return wrapper
     return requires_auth_decorator
\ No newline at end of file
@@ -0,0 +1,92 @@
+'''
+Token verification benchmark.  Run from the repo root:
+
+    python benchmarks/bench_auth.py
+
+Everything runs offline with a throwaway key (see tokens.py).  Verifies an
+RS256 token the old way (parse the JWKS and rebuild the RSA key from n/e on
+every call, not counting the download) and with a JWTVerifier, which keeps the
+parsed key, then times whole authenticated requests through the app.  Prints
+verifications (or requests) per second.
+'''
+import os
+import sys
+import json
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jose import jwt
+
+import tokens
+from auth import JWTVerifier, LOCAL_ISSUER
+
+AUDIENCE = 'roboterms-api'
+
+
+def verify_old(token, jwks_text):
+    '''What verify_decode_jwt used to do per call, minus the urlopen'''
+    jwks = json.loads(jwks_text)
+    kid = jwt.get_unverified_header(token)['kid']
+    rsa_key = {}
+    for key in jwks['keys']:
+        if key['kid'] == kid:
+            rsa_key = {k: key[k] for k in ('kty', 'kid', 'use', 'n', 'e')}
+            break
+    return jwt.decode(token, rsa_key, algorithms=['RS256'], audience=AUDIENCE, issuer=LOCAL_ISSUER)
+
+
+class MemoryKeyProvider:
+    def __init__(self, jwks):
+        self.jwks = jwks
+
+    def fetch_jwks(self):
+        return self.jwks
+
+
+def per_second(fn, number):
+    return number / min(timeit.repeat(fn, number=number, repeat=5))
+
+
+def bench_requests(jwks, token, number):
+    '''Authenticated DELETEs of a company that doesn't exist: all auth, one tiny query'''
+    from app import create_app
+    from models import db
+
+    with tempfile.TemporaryDirectory() as tmp:
+        jwks_path = os.path.join(tmp, 'jwks.json')
+        with open(jwks_path, 'w') as jwks_file:
+            json.dump(jwks, jwks_file)
+        app = create_app({
+            "DATABASE_URL": "sqlite://",
+            "AUTH_JWKS_FILE": jwks_path,
+            "RATELIMIT_ENABLED": False,
+            "LOG_SAMPLE_RATE": 0,
+        })
+        with app.app_context():
+            db.create_all()
+        client = app.test_client()
+        headers = {'Authorization': 'Bearer ' + token}
+        assert client.delete('/company/1', headers=headers).status_code == 404
+        return per_second(lambda: client.delete('/company/1', headers=headers), number)
+
+
+def main(number=500):
+    private_pem, jwks = tokens.generate_keys()
+    token = tokens.mint_token(private_pem, tokens.ROLES['client'])
+    jwks_text = json.dumps(jwks)
+    verifier = JWTVerifier(MemoryKeyProvider(jwks), ['RS256'], AUDIENCE, LOCAL_ISSUER)
+    assert verify_old(token, jwks_text) == verifier.verify(token)
+
+    print(f'RS256, 2048 bit key, {number} verifications x 5')
+    old = per_second(lambda: verify_old(token, jwks_text), number)
+    new = per_second(lambda: verifier.verify(token), number)
+    requests = bench_requests(jwks, token, number)
+    print(f'  rebuild key per call: {old:10,.0f} verifications/sec  (plus a JWKS download each, before)')
+    print(f'  JWTVerifier:          {new:10,.0f} verifications/sec  ({new / old:.1f}x)')
+    print(f'  DELETE /company/<id>: {requests:10,.0f} requests/sec (test client, SQLite)')
+
+
+if __name__ == '__main__':
+    main()
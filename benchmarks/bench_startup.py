@@ -0,0 +1,74 @@
+'''
+Startup benchmark.  Run from the repo root:
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --budget-ms 400   # fail if slower
+
+Imports app.py in a fresh interpreter with -X importtime and reports the total
+import time plus the slowest top-level modules.  Exits with status 1 if the
+total is over --budget-ms, or if a lazy dependency got pulled in at import.
+'''
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# These should only load on first use (see app.py and auth.py)
+LAZY_MODULES = ['markdown', 'pygments', 'jose', 'Crypto']
+
+
+def import_times(module='app'):
+    '''Returns a list of (cumulative_us, module_name) for top-level imports'''
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=ROOT, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL,
+        universal_newlines=True, check=True
+    )
+
+    times = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times.append((int(cumulative), name.rstrip()))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--budget-ms', type=float, default=None)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    totals = []
+    for _ in range(args.runs):
+        times = import_times()
+        # Only count the outermost imports, nested ones are already in cumulative
+        top_level = [(us, name) for us, name in times if not name.startswith('  ')]
+        totals.append(sum(us for us, _ in top_level))
+
+    best_ms = min(totals) / 1000
+    print(f'import app: best {best_ms:.1f} ms over {args.runs} runs')
+    for us, name in sorted(top_level, reverse=True)[:args.top]:
+        print(f'  {us / 1000:8.1f} ms  {name.strip()}')
+
+    failed = False
+    loaded = {name.strip().split('.')[0] for _, name in times}
+    for module in LAZY_MODULES:
+        if module in loaded:
+            print(f'FAIL: {module} imported at startup, should be lazy')
+            failed = True
+
+    if args.budget_ms is not None and best_ms > args.budget_ms:
+        print(f'FAIL: {best_ms:.1f} ms is over the {args.budget_ms:.1f} ms budget')
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+'''
+Template benchmark.  Run from the repo root:
+
+    python benchmarks/bench_template.py
+
+Fills in a 3000 character policy body with str.format (the old way) and with
+a compiled policy_template.Template, and prints microseconds per render.
+'''
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from policy_template import compile_template
+
+PARAGRAPH = (
+    "These Terms of Service govern your access to and use of the website {WEBSITE} and all its services. "
+    "{COMPANY} respects the intellectual property rights of others and expects users of the Services to do the same. "
+    "Questions about these Terms can be sent to {CONTACT_EMAIL}. "
+    "These Terms are governed by the laws of {JURISDICTION} and are effective as of {EFFECTIVE_DATE}.\n\n"
+)
+
+VALUES = {
+    'COMPANY': "Green Cola, Inc.",
+    'WEBSITE': "gcola.com",
+    'CONTACT_EMAIL': "legal@gcola.com",
+    'JURISDICTION': "the State of Oregon",
+    'EFFECTIVE_DATE': "June 1, 2020",
+}
+
+
+def make_body(length=3000):
+    body = PARAGRAPH
+    while len(body) < length:
+        body += PARAGRAPH
+    # Cut at a paragraph boundary near the target length
+    return body[:body.rindex('\n\n', 0, length) + 2]
+
+
+def best_us(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+
+def main(number=20000):
+    body = make_body()
+    template = compile_template(body)
+    assert template.render(VALUES) == body.format(**VALUES)
+
+    print(f'{len(body)} character body, {len(template.fields)} placeholders, {number} renders x 5')
+    old = best_us(lambda: body.format(**VALUES), number)
+    new = best_us(lambda: template.render(VALUES), number)
+    compile_us = best_us(lambda: compile_template.__wrapped__(body), 200)
+    print(f'  str.format:        {old:8.2f} us/render')
+    print(f'  compiled template: {new:8.2f} us/render  ({old / new:.1f}x faster)')
+    print(f'  compile (once):    {compile_us:8.2f} us')
+
+
+if __name__ == '__main__':
+    main()
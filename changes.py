@@ -0,0 +1,53 @@
+import time
+import threading
+
+# Long polling for GET /changes
+#
+# A client that's caught up asks for changes after its cursor and waits.  The
+# feed wakes it as soon as this worker commits a change, and checks the
+# database every poll_interval seconds for changes committed by other workers.
+#
+# EXAMPLE
+#     feed = ChangeFeed(poll_interval=1)
+#     changes = feed.wait(lambda: changes_since(cursor), timeout=20)
+#     ...
+#     feed.notify()     # after committing a change
+
+
+class ChangeFeed:
+    def __init__(self, poll_interval=1.0):
+        self.poll_interval = poll_interval
+        self._changed = threading.Condition()
+        self._version = 0   # Bumped by every notify()
+        self.waiting = 0    # Clients long polling right now
+
+    def notify(self):
+        '''A change was just committed, wake everybody waiting'''
+        with self._changed:
+            self._version += 1
+            self._changed.notify_all()
+
+    def wait(self, fetch, timeout):
+        '''
+        Calls fetch() until it returns something (e.g. a non-empty list), or
+        timeout seconds have passed, and returns its last result
+        '''
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            self.waiting += 1
+        try:
+            while True:
+                with self._changed:
+                    version = self._version
+                result = fetch()
+                remaining = deadline - time.monotonic()
+                if result or remaining <= 0:
+                    return result
+
+                with self._changed:
+                    # A notify() during fetch() means go again right away
+                    if self._version == version:
+                        self._changed.wait(min(remaining, self.poll_interval))
+        finally:
+            with self._changed:
+                self.waiting -= 1
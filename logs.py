@@ -0,0 +1,224 @@
+import re
+import sys
+import json
+import time
+import uuid
+import queue
+import random
+import atexit
+import logging
+import logging.handlers
+import threading
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Structured logging
+#
+# Every log line is one JSON object tagged with the request's id.  Lines are
+# formatted in the thread that logs them, then handed to a queue, and a
+# background thread does the (slow, blocking) writing, so a request never waits
+# on stderr.  If the queue is ever full, lines are dropped rather than blocking.
+#
+# On top of that:
+#   - one "request" line per request, for a LOG_SAMPLE_RATE fraction of them
+#   - a "slow request" warning for every request over SLOW_REQUEST_MS
+#   - a "slow query" warning for every SQL statement over SLOW_QUERY_MS
+#   - a "worker stats" line every STATS_LOG_INTERVAL seconds with counters
+#     like request coalescing's (see init_stats_log)
+# The request lines include how many queries the request ran and how long they
+# took, so slow requests can be matched up with their queries.
+#
+# Config (see create_app):
+#   LOG_LEVEL         e.g. 'INFO'
+#   LOG_JSON          False for plain text lines (easier to read locally)
+#   LOG_SAMPLE_RATE   0.0 - 1.0, fraction of ordinary requests that get a "request" line
+#   SLOW_REQUEST_MS   requests slower than this are always logged
+#   SLOW_QUERY_MS     queries slower than this are always logged
+#   STATS_LOG_INTERVAL  seconds between "worker stats" lines, 0 = never
+
+log = logging.getLogger(__name__)
+
+QUEUE_SIZE = 10000
+
+_REQUEST_ID = re.compile(r'^[A-Za-z0-9._-]{1,128}$')
+
+# Thresholds used by the SQLAlchemy hooks, set by init_logging()
+_settings = {
+    'slow_query_ms': 100,
+}
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    converter = time.gmtime     # Timestamps in UTC
+
+    def format(self, record):
+        line = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+        }
+        # Anything passed with extra={'fields': {...}}
+        line.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            line['exc'] = self.formatException(record.exc_info)
+        return json.dumps(line, default=str)
+
+
+_make_record = logging.getLogRecordFactory()
+
+
+def _record_with_request_id(*args, **kwargs):
+    '''Tags every log record with the id of the request being handled, if any'''
+    record = _make_record(*args, **kwargs)
+    record.request_id = g.get('request_id') if has_request_context() else None
+    return record
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    '''Never blocks the caller: formats the line, and drops it if the queue is full'''
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+    def prepare(self, record):
+        # Format here, in the caller's thread (the request id lives in this thread)
+        record.msg = self.format(record)
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+
+def start_logging(level='INFO', as_json=True):
+    '''
+    Sends everything logged in this process through the queue, once per process
+    '''
+    global _listener
+    root = logging.getLogger()
+    root.setLevel(level)
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(logging.Formatter('%(message)s'))   # Already formatted
+
+    logging.setLogRecordFactory(_record_with_request_id)
+
+    handler = DroppingQueueHandler(queue.Queue(QUEUE_SIZE))
+    handler.setFormatter(JsonFormatter() if as_json else
+                         logging.Formatter('%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s'))
+    root.addHandler(handler)
+
+    _listener = logging.handlers.QueueListener(handler.queue, output, respect_handler_level=False)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+## Slow query log
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('query_started')
+    if not started:
+        return
+    elapsed_ms = (time.perf_counter() - started.pop()) * 1000
+
+    if has_request_context():
+        g.db_queries = g.get('db_queries', 0) + 1
+        g.db_ms = g.get('db_ms', 0) + elapsed_ms
+
+    if elapsed_ms >= _settings['slow_query_ms']:
+        log.warning('slow query', extra={'fields': {
+            'duration_ms': round(elapsed_ms, 1),
+            'statement': statement[:1000],
+            'executemany': executemany,
+        }})
+
+
+## Request ids, request log and slow request log
+
+def init_logging(app):
+    '''
+    init_logging(app)
+    Sets up logging from app.config (see top of file) and hooks into the app's requests
+    '''
+    start_logging(app.config.get('LOG_LEVEL', 'INFO'), app.config.get('LOG_JSON', True))
+    _settings['slow_query_ms'] = app.config.get('SLOW_QUERY_MS', 100)
+    sample_rate = app.config.get('LOG_SAMPLE_RATE', 1.0)
+    slow_request_ms = app.config.get('SLOW_REQUEST_MS', 500)
+
+    @app.before_request
+    def start_request_log():
+        # Keep the caller's id if they sent a sane one (e.g. Heroku's router does)
+        request_id = request.headers.get('X-Request-ID', '')
+        g.request_id = request_id if _REQUEST_ID.match(request_id) else uuid.uuid4().hex
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def add_request_id(response):
+        if 'request_id' in g:
+            response.headers['X-Request-ID'] = g.request_id
+        g.status = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_request_log(error=None):
+        if 'request_started' not in g:
+            return
+        elapsed_ms = (time.perf_counter() - g.request_started) * 1000
+        status = 500 if error is not None else g.get('status', 500)
+
+        fields = {
+            'method': request.method,
+            'path': request.path,
+            'status': status,
+            'duration_ms': round(elapsed_ms, 1),
+            'db_queries': g.get('db_queries', 0),
+            'db_ms': round(g.get('db_ms', 0), 1),
+            'remote_addr': request.remote_addr,
+        }
+        if elapsed_ms >= slow_request_ms:
+            log.warning('slow request', extra={'fields': fields})
+        elif status >= 500:
+            log.error('request failed', extra={'fields': fields})
+        elif random.random() < sample_rate:
+            log.info('request', extra={'fields': fields})
+
+
+## Worker stats
+
+def init_stats_log(app, sources):
+    '''
+    init_stats_log(app, {'singleflight': reads.stats})
+    Logs a "worker stats" line with every source's counters (its stats() dict)
+    at most every STATS_LOG_INTERVAL seconds.  Checked at the end of requests,
+    so an idle worker logs nothing.
+    '''
+    interval = app.config.get('STATS_LOG_INTERVAL', 60)
+    if not interval:
+        return
+    state = {'next_at': time.monotonic() + interval}
+    lock = threading.Lock()
+
+    @app.teardown_request
+    def log_worker_stats(error=None):
+        if time.monotonic() < state['next_at'] or not lock.acquire(blocking=False):
+            return
+        try:
+            state['next_at'] = time.monotonic() + interval
+            log.info('worker stats', extra={'fields': {name: stats() for name, stats in sources.items()}})
+        finally:
+            lock.release()
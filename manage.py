@@ -1,8 +1,16 @@
-from flask_script import Manager
+import os
+import sys
+import json
+from datetime import timedelta
+
+from flask_script import Manager, Command, Option
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
-from models import db
+from models import db, purge_deleted, pop_policies, pop_mock_companies, DEFAULT_TENANT, Policy
+import seed as seeding
+import tokens
+from auth import make_verifier, JWKSFileKeyProvider, LOCAL_ISSUER
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +18,149 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=500,
+                help='Companies removed per transaction')
+@manager.option('-d', '--older-than-days', dest='older_than_days', type=float, default=0,
+                help='Only purge companies deleted at least this many days ago')
+def purge(batch_size, older_than_days):
+    '''Removes soft deleted companies and everything depending on them'''
+    total = 0
+    for removed in purge_deleted(batch_size=batch_size, older_than=timedelta(days=older_than_days)):
+        total += removed
+        print(f'Purged {total} companies...')
+    print(f'Done, purged {total} companies')
+
+
+
+@manager.option('-n', '--companies', dest='companies', type=int, default=0,
+                help='How many synthetic companies to generate')
+@manager.option('-s', '--seed', dest='seed', type=int, default=0,
+                help='Random seed, the same seed always generates the same companies')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=5000,
+                help='Rows written per transaction')
+@manager.option('--reset', dest='reset', action='store_true',
+                help='Drop and recreate all tables, then add the initial policies')
+@manager.option('--mock', dest='mock', action='store_true',
+                help='Add the three mock companies used during development')
+@manager.option('-t', '--tenant', dest='tenant', default=DEFAULT_TENANT,
+                help='Tenant for --policies and the synthetic companies')
+@manager.option('--policies', dest='policies', action='store_true',
+                help="Add the initial policies to the tenant's catalog")
+def seed(companies, seed, batch_size, reset, mock, tenant, policies):
+    '''Creates the initial data, and/or lots of deterministic fake companies for load testing'''
+    if reset:
+        db.drop_all()
+        db.create_all()
+        pop_policies()
+        print('Recreated tables and added the initial policies')
+    if mock:
+        pop_mock_companies()
+        print('Added the mock companies')
+    if policies:
+        # --reset already gave the default tenant its policies, and adding them twice would clash
+        if Policy.query.filter(Policy.tenant_id == tenant).first():
+            print(f'Tenant {tenant} already has policies, left them as they are')
+        else:
+            pop_policies(tenant)
+            print(f'Added the initial policies to tenant {tenant}')
+
+    if companies:
+        # Numbered after the companies already there, so names stay unique
+        start = db.session.query(db.func.max(seeding.Company.id)).scalar() or 0
+        rows = seeding.synthetic_companies(companies, seed=seed, start=start)
+        total, seconds = seeding.load('company', rows, batch_size=batch_size, progress=print, tenant_id=tenant)
+        print(f'Done, {total} companies in {seconds:.1f}s ({total / max(seconds, 1e-9):,.0f} rows/sec)')
+
+
+class ImportCommand(Command):
+    '''Streams companies or policies from a CSV or NDJSON file (- for stdin) into the database'''
+
+    option_list = (
+        Option('path', help='CSV (with a header line) or NDJSON file, - for stdin'),
+        Option('-m', '--model', dest='model', choices=sorted(seeding.COLUMNS), default='company'),
+        Option('-f', '--format', dest='fmt', choices=sorted(seeding.READERS), default=None,
+               help='Default: from the file extension'),
+        Option('-b', '--batch-size', dest='batch_size', type=int, default=5000,
+               help='Rows written per transaction'),
+        Option('-t', '--tenant', dest='tenant', default=DEFAULT_TENANT,
+               help="Tenant for rows without a tenant_id column"),
+    )
+
+    def run(self, path, model, fmt, batch_size, tenant):
+        if fmt is None:
+            fmt = 'csv' if path.endswith('.csv') else 'ndjson'
+
+        try:
+            stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        except OSError as e:
+            sys.exit(f'Import stopped: {e}')
+
+        try:
+            rows = seeding.READERS[fmt](stream)
+            total, seconds = seeding.load(model, rows, batch_size=batch_size, progress=print, tenant_id=tenant)
+        except ValueError as e:
+            # Batches before the bad row are already saved
+            sys.exit(f'Import stopped: {e}')
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        print(f'Done, {total} {model} rows in {seconds:.1f}s ({total / max(seconds, 1e-9):,.0f} rows/sec)')
+
+
+manager.add_command('import', ImportCommand())
+
+
+
+@manager.option('-k', '--key', dest='key_path', default='local_auth_key.pem',
+                help='Where to write the private key')
+@manager.option('-j', '--jwks', dest='jwks_path', default='local_jwks.json',
+                help='Where to write the public keys, point AUTH_JWKS_FILE at this')
+@manager.option('--bits', dest='bits', type=int, default=2048)
+def keygen(key_path, jwks_path, bits):
+    '''Makes an RSA key pair for signing local tokens (see manage.py token)'''
+    private_pem, jwks = tokens.generate_keys(bits)
+
+    # The private key is only readable by you
+    with open(os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as key_file:
+        key_file.write(private_pem)
+    with open(jwks_path, 'w') as jwks_file:
+        json.dump(jwks, jwks_file, indent=2)
+    print(f'Wrote {key_path} and {jwks_path}, now: export AUTH_JWKS_FILE={jwks_path}')
+
+
+@manager.option('-r', '--role', dest='role', choices=sorted(tokens.ROLES), default=None,
+                help="Give the role's permissions")
+@manager.option('-p', '--permission', dest='permissions', action='append', default=[],
+                help='Add a permission, e.g. -p post:company (can be repeated)')
+@manager.option('-s', '--sub', dest='sub', default='local|tester', help='Subject (user id) of the token')
+@manager.option('-t', '--tenant', dest='tenant', default=None,
+                help='Tenant the token belongs to (its TENANT_CLAIM claim), none = the default tenant')
+@manager.option('-e', '--expires-hours', dest='expires_hours', type=float, default=24)
+@manager.option('-k', '--key', dest='key_path', default='local_auth_key.pem',
+                help='Private key from manage.py keygen')
+def token(role, permissions, sub, tenant, expires_hours, key_path):
+    '''Prints a locally signed token, e.g. export CLIENT_TOKEN=$(python manage.py token --role client)'''
+    permissions = (tokens.ROLES[role] if role else []) + permissions
+    with open(key_path) as key_file:
+        private_pem = key_file.read()
+
+    # Same audience and issuer the app checks for
+    try:
+        verifier = make_verifier(app.config)
+        audience, issuer = verifier.api_audience, verifier.issuer
+    except RuntimeError:
+        # No auth settings at all, so use what the app will check once AUTH_JWKS_FILE is set
+        verifier = None
+        audience = app.config.get('API_AUDIENCE') or os.getenv('API_AUDIENCE') or 'roboterms-api'
+        issuer = app.config.get('AUTH_ISSUER') or os.getenv('AUTH_ISSUER') or LOCAL_ISSUER
+    if not isinstance(getattr(verifier, 'key_provider', None), JWKSFileKeyProvider):
+        print('WARNING: AUTH_JWKS_FILE is not set, so the app will not accept this token', file=sys.stderr)
+
+    claims = {app.config['TENANT_CLAIM']: tenant} if tenant else {}
+    print(tokens.mint_token(private_pem, permissions, sub=sub, audience=audience,
+                            issuer=issuer, expires_in=expires_hours * 3600, **claims))
+
+
 if __name__ == '__main__':
     manager.run()
\ No newline at end of file
@@ -1,34 +1,100 @@
 import os
+import json
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 # from sqlalchemy import Column, String, Integer, Table, ForeignKey
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from replicas import RoutingSQLAlchemy, init_replicas
+from render import template
+from policy_template import TemplateError
 
-# Ensure that setup.sh has been sourced. Fail if variables not set
-if not os.getenv('DATABASE_URL'):
-    raise RuntimeError("Environment variables are not set, did you source setup.sh?")
+# Like SQLAlchemy(), but can send reads to replicas (see replicas.py)
+db = RoutingSQLAlchemy()
 
-database_path = os.getenv('DATABASE_URL')
+# Tenant of everything made without one (and of tokens without a tenant claim)
+DEFAULT_TENANT = 'default'
 
-db = SQLAlchemy()
 
-
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=None):
     '''
     setup_db(app)
     binds a flask application and a SQLAlchemy service
+    database_path defaults to app.config["DATABASE_URL"], then the environment
     '''
+    database_path = database_path or app.config.get("DATABASE_URL") or os.getenv('DATABASE_URL')
+
+    # Ensure that setup.sh has been sourced (or test_config given). Fail if not set
+    if not database_path:
+        raise RuntimeError("Environment variables are not set, did you source setup.sh?")
+
     # print(f"Using database_path={database_path}")
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     db.app = app
     db.init_app(app)
+    init_replicas(app)
+
+    # To (re)create the tables with the initial policies, and mock companies:
+    #   python manage.py seed --reset --mock
+
+
+'''
+Unit of work
+Groups model operations into one transaction.  Inside the block, insert(),
+update() and delete() don't commit, everything is committed once at the end
+(or all rolled back if there's an exception).  A unit_of_work() inside another
+one is a SAVEPOINT, so a failure there only undoes that inner block.
+EXAMPLE
+    with unit_of_work():
+        for name, website in rows:
+            Company(name=name, website=website).insert()
+'''
+@contextmanager
+def unit_of_work():
+    session = db.session
+    depth = session.info.get('unit_of_work', 0)
+    transaction = session.begin_nested() if depth else None
+    session.info['unit_of_work'] = depth + 1
+    try:
+        yield session
+        if transaction:
+            transaction.commit()
+        else:
+            session.commit()
+    except BaseException:
+        if transaction:
+            transaction.rollback()
+        else:
+            session.rollback()
+        raise
+    finally:
+        session.info['unit_of_work'] = depth
+
+
+def commit():
+    '''
+    commit()
+    What the model helpers call instead of db.session.commit(), so they leave
+    committing to the unit of work when they're inside one
+    '''
+    if not db.session.info.get('unit_of_work'):
+        db.session.commit()
+
+
+# pysqlite starts transactions itself and breaks SAVEPOINTs, so take over
+# (the recipe from the SQLAlchemy docs).  Lets unit_of_work() nest on SQLite too.
+@event.listens_for(Engine, 'connect')
+def _sqlite_connect(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.isolation_level = None
+
 
-    # Turn this off after initial run or will keep overwriting database!
-    if 0:
-        db.drop_all()
-        db.create_all()
-        pop_policies()          # See below for initial policy population
-    if 0:
-        pop_mock_companies()    # See below.  Used only during development.
+@event.listens_for(Engine, 'begin')
+def _sqlite_begin(conn):
+    if conn.dialect.name == 'sqlite':
+        conn.execute('BEGIN')
 
 
 class Company(db.Model):
@@ -36,12 +102,72 @@ class Company(db.Model):
     # Autoincrementing, unique primary key
     id = db.Column(db.Integer, primary_key=True)
     
-    name = db.Column(db.String(80), unique=True, nullable=False)
-    website = db.Column(db.String(80), unique=True, nullable=False)
+    # Unique among live companies only, see the indexes below
+    name = db.Column(db.String(80), nullable=False)
+    website = db.Column(db.String(80), nullable=False)
+
+    # Optional details for the policy placeholders (see policy_template.py)
+    contact_email = db.Column(db.String(120), nullable=True)
+    jurisdiction = db.Column(db.String(80), nullable=True)
+    effective_date = db.Column(db.Date, nullable=True)
+
+    # Soft delete.  Set by delete(), the row is really removed later by purge_deleted()
+    deleted_at = db.Column(db.DateTime, nullable=True)
+
+    # Which customer (reseller) the company belongs to, see tenants.py
+    tenant_id = db.Column(db.String(64), nullable=False, default=DEFAULT_TENANT, server_default=DEFAULT_TENANT)
+
+    # Partial indexes, so live-row queries never have to wade through tombstones
+    # and a deleted company's name/website can be used again.  Tenant first, as
+    # every query is for one tenant, and names only need to be unique within it.
+    __table_args__ = (
+        db.Index('ix_company_live', 'tenant_id', 'id',
+                 postgresql_where=deleted_at.is_(None), sqlite_where=deleted_at.is_(None)),
+        db.Index('ix_company_name_live', 'tenant_id', 'name', unique=True,
+                 postgresql_where=deleted_at.is_(None), sqlite_where=deleted_at.is_(None)),
+        db.Index('ix_company_website_live', 'tenant_id', 'website', unique=True,
+                 postgresql_where=deleted_at.is_(None), sqlite_where=deleted_at.is_(None)),
+    )
 
     def __repr__(self):
         return f"Company object with name: {self.name} and site: {self.website}"
 
+    '''
+    template_values() method
+    Values for the policy placeholders, as (placeholder, value) pairs
+    '''
+    def template_values(self):
+        date = self.effective_date
+        return (
+            ('COMPANY', self.name),
+            ('WEBSITE', self.website),
+            ('CONTACT_EMAIL', self.contact_email),
+            ('JURISDICTION', self.jurisdiction),
+            ('EFFECTIVE_DATE', f"{date:%B} {date.day}, {date.year}" if date else None),
+        )
+
+    '''
+    live() class method
+    Query of companies that haven't been deleted, in tenant_id if given.  Use this instead of Company.query
+    EXAMPLE
+        co = Company.live('default').filter_by(name="Green Cola, Inc.").one_or_none()
+    '''
+    @classmethod
+    def live(cls, tenant_id=None):
+        query = cls.query.filter(cls.deleted_at.is_(None))
+        if tenant_id is not None:
+            query = query.filter(cls.tenant_id == tenant_id)
+        return query
+
+    '''
+    get_live() class method
+    Like Company.query.get(co_id) but returns None for deleted companies (and
+    for companies of other tenants, if tenant_id is given)
+    '''
+    @classmethod
+    def get_live(cls, co_id, tenant_id=None):
+        return cls.live(tenant_id).filter(cls.id == co_id).one_or_none()
+
     '''
     insert() method
     Creates a new company
@@ -51,7 +177,7 @@ class Company(db.Model):
     '''
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit()
 
     '''
     update() method
@@ -62,18 +188,27 @@ class Company(db.Model):
         co.update()
     '''
     def update(self):
-        db.session.commit()
+        commit()
 
     '''
     delete() method
-    Deletes a row from the database
+    Soft deletes the company: marks it deleted so every query skips it, and
+    leaves removing the row (and anything depending on it) to purge_deleted()
     EXAMPLE
-        co = Company.query.get(co_id)
+        co = Company.get_live(co_id)
         co.delete()
     '''
     def delete(self):
+        self.deleted_at = datetime.utcnow()
+        commit()
+
+    '''
+    purge() method
+    Really deletes the row from the database, right now
+    '''
+    def purge(self):
         db.session.delete(self)
-        db.session.commit()
+        commit()
 
     
 class Policy(db.Model):
@@ -82,26 +217,45 @@ class Policy(db.Model):
     # Autoincrementing, unique primary key
     id = db.Column(db.Integer, primary_key=True)
     
-    name = db.Column(db.String(80), unique=True, nullable=False)
+    name = db.Column(db.String(80), nullable=False)
     body =  db.Column(db.String(3000), nullable=False)
 
+    # Every tenant has its own catalog of policies, see tenants.py
+    tenant_id = db.Column(db.String(64), nullable=False, default=DEFAULT_TENANT, server_default=DEFAULT_TENANT)
+
+    # Names are unique within a tenant's catalog
+    __table_args__ = (
+        db.Index('ix_policy_tenant_name', 'tenant_id', 'name', unique=True),
+    )
+
     def __repr__(self):
         return f"Policy object with name: {self.name} and begins: {self.data[0:10]}"
 
+    '''
+    Bodies are compiled as templates whenever they're set, so a broken one
+    raises TemplateError here instead of when somebody renders it
+    '''
+    @db.validates('body')
+    def validate_body(self, key, body):
+        if not isinstance(body, str):
+            raise TemplateError("Policy body must be a string")
+        template(body)
+        return body
+
     '''
     insert() method
     Creates a new policy
     '''
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit()
 
     '''
     update() method
     Updates a row already in the database
     '''
     def update(self):
-        db.session.commit()
+        commit()
 
     '''
     delete() method
@@ -109,10 +263,162 @@ class Policy(db.Model):
     '''
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit()
+
+
+class Change(db.Model):
+    '''
+    One entry in the change log read by GET /changes.  Rows are only ever added
+    (see record_change), and the id is the feed's cursor.  The one exception is
+    purge_deleted(), which clears the data of the companies it removes.
+    '''
+    __tablename__ = 'Change'
+
+    # Autoincrementing, so ordered the same as the changes were committed
+    id = db.Column(db.Integer, primary_key=True)
+
+    entity = db.Column(db.String(20), nullable=False)      # 'company' or 'policy'
+    entity_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(10), nullable=False)      # 'create', 'update' or 'delete'
+    data = db.Column(db.Text, nullable=True)               # JSON of the row after the change, None for deletes
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    # Each tenant reads only its own changes
+    tenant_id = db.Column(db.String(64), nullable=False, default=DEFAULT_TENANT, server_default=DEFAULT_TENANT)
+
+    __table_args__ = (
+        db.Index('ix_change_tenant', 'tenant_id', 'id'),
+        # For finding a company's changes when it's purged
+        db.Index('ix_change_entity', 'entity', 'entity_id'),
+    )
+
+    def __repr__(self):
+        return f"Change {self.id}: {self.action} {self.entity} {self.entity_id}"
+
+
+# Any number, as long as nothing else uses it as a Postgres advisory lock key
+CHANGE_LOG_LOCK = 0x526f626f
+
+
+def record_change(action, *objs):
+    '''
+    record_change('create', company)
+    Adds a change to the log for each company or policy in objs.  Call it inside
+    the unit_of_work() making the change, so both are committed together or not at all.
+    '''
+    db.session.flush()  # So new rows have their ids
+
+    if db.engine.dialect.name == 'postgresql':
+        # Writers take turns appending, until they commit, so change ids are
+        # committed in order and a reader at cursor 10 can't miss a late 9.
+        # (SQLite only ever has one writer anyway.)
+        db.session.execute(f'SELECT pg_advisory_xact_lock({CHANGE_LOG_LOCK})')
+
+    for obj in objs:
+        entity, as_dict = CHANGE_ENTITIES[type(obj)]
+        db.session.add(Change(
+            tenant_id=obj.tenant_id,
+            entity=entity,
+            entity_id=obj.id,
+            action=action,
+            data=None if action == 'delete' else json.dumps(as_dict(obj))
+        ))
+
+
+'''
+Read helpers
+These return plain dicts and strings instead of model objects, so one thread's
+result can be handed to other threads (see singleflight.py in app.py)
+'''
+def company_dict(co):
+    return {
+        "id": co.id,
+        "name": co.name,
+        "website": co.website,
+        "contact_email": co.contact_email,
+        "jurisdiction": co.jurisdiction,
+        "effective_date": co.effective_date.isoformat() if co.effective_date else None
+    }
+
+
+def policy_dict(pol):
+    return {
+        "id": pol.id,
+        "name": pol.name,
+        "body": pol.body
+    }
+
+
+# What the change log calls each model, and how it writes one down
+CHANGE_ENTITIES = {
+    Company: ('company', company_dict),
+    Policy: ('policy', policy_dict),
+}
+
+
+def company_list(tenant_id=DEFAULT_TENANT):
+    return [company_dict(co) for co in Company.live(tenant_id).all()]
+
+
+def changes_since(cursor, limit=100, tenant_id=DEFAULT_TENANT):
+    '''
+    The tenant's first limit changes after cursor (a Change id, 0 for the beginning), oldest first
+    '''
+    changes = Change.query.filter(Change.tenant_id == tenant_id, Change.id > cursor) \
+        .order_by(Change.id).limit(limit).all()
+    return [{
+        "cursor": str(change.id),
+        "entity": change.entity,
+        "id": change.entity_id,
+        "action": change.action,
+        "at": change.created_at.isoformat() + 'Z',
+        "data": json.loads(change.data) if change.data is not None else None
+    } for change in changes]
+
 
+# Models with rows that belong to a company, as (model, foreign key column name).
+# purge_deleted() removes these before the company rows themselves.
+COMPANY_DEPENDENTS = []
 
-def pop_policies():
+
+def purge_deleted(batch_size=500, older_than=timedelta(0)):
+    '''
+    purge_deleted()
+    Really deletes soft deleted companies (and their dependent rows), batch_size
+    companies per transaction so locks are only ever held briefly.  Their
+    entries in the change log are kept, but without the company's details.
+    Generator, yields the number of companies removed after each batch.
+    EXAMPLE
+        for removed in purge_deleted(batch_size=1000):
+            print(removed)
+    '''
+    cutoff = datetime.utcnow() - older_than
+    while True:
+        ids = [row.id for row in db.session.query(Company.id)
+               .filter(Company.deleted_at.isnot(None), Company.deleted_at <= cutoff)
+               .order_by(Company.id)
+               .limit(batch_size)]
+        if not ids:
+            break
+
+        with unit_of_work():
+            for model, column in COMPANY_DEPENDENTS:
+                model.query.filter(getattr(model, column).in_(ids)).delete(synchronize_session=False)
+            Company.query.filter(Company.id.in_(ids)).delete(synchronize_session=False)
+            Change.query.filter(Change.entity == 'company', Change.entity_id.in_(ids),
+                                Change.data.isnot(None)) \
+                .update({Change.data: None}, synchronize_session=False)
+
+        yield len(ids)
+
+
+def pop_policies(tenant_id=DEFAULT_TENANT):
+    # All four go in one transaction
+    with unit_of_work():
+        _pop_policies(tenant_id)
+
+
+def _pop_policies(tenant_id=DEFAULT_TENANT):
     # Add the policy boilerplate
     # 1. Terms of Service
     # 2. Cookie policy
@@ -124,7 +430,7 @@ def pop_policies():
     # NOTE: These policies are extremely abbreviated and just for a homework assignment.
     # DO NOT USE THEM FOR ANY COMMERCIAL PRODUCTS!  Also, I am not a lawyer.
 
-    tos = Policy(name="Terms of Service", body='''
+    tos = Policy(tenant_id=tenant_id, name="Terms of Service", body='''
         TERMS OF SERVICE
 
         These Terms of Service ("Terms") govern your access to and use of the website "{WEBSITE}" and all its services.  Your access to and use of the Services are conditioned on your acceptance of and compliance with these Terms. By accessing or using the Services you agree to be bound by these Terms.
@@ -140,7 +446,7 @@ def pop_policies():
     )
     tos.insert()
 
-    cookies = Policy(name="Cookies Policy", body='''
+    cookies = Policy(tenant_id=tenant_id, name="Cookies Policy", body='''
         COOKIES POLICY
 
         {COMPANY} ("us", "we", or "our") uses cookies on "{WEBSITE}" (the "Service"). By using the Service, you consent to the use of cookies.
@@ -166,7 +472,7 @@ def pop_policies():
     )
     cookies.insert()
 
-    disclaimer = Policy(name="Disclaimer", body='''
+    disclaimer = Policy(tenant_id=tenant_id, name="Disclaimer", body='''
         DISCLAIMER
 
         This website {WEBSITE} owned and operated by {COMPANY} makes no representations as to accuracy, completeness, correctness, suitability, or validity of any information on this site and will not be liable for any errors, omissions, or delays in this information or any losses injuries, or damages arising from its display or use. All information is provided on an as-is basis.
@@ -176,7 +482,7 @@ def pop_policies():
     )
     disclaimer.insert()
 
-    privacy = Policy(name="Privacy Policy", body='''
+    privacy = Policy(tenant_id=tenant_id, name="Privacy Policy", body='''
         PRIVACY POLICY
 
         This statement ("Privacy Policy") covers the website {WEBSITE} owned and operated by {COMPANY} ("we", "us", "our") and all associated services.
@@ -203,6 +509,11 @@ def pop_policies():
 
 
 def pop_mock_companies():
+    with unit_of_work():
+        _pop_mock_companies()
+
+
+def _pop_mock_companies():
     # Add new companies
     new_co = Company(name="Green Cola, Inc.", website="gcola.com")
     new_co.insert()
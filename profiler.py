@@ -0,0 +1,168 @@
+import io
+import sys
+import time
+import cProfile
+import pstats
+import logging
+import threading
+from collections import Counter
+from flask import Response, request, g, abort
+
+from auth import get_token_auth_header, verify_decode_jwt, check_permissions
+
+# On-demand profiling for production workers
+#
+#   GET /profile?seconds=10
+#       samples every thread in this worker for a few seconds and returns
+#       collapsed stacks (one "frame;frame;frame count" line per stack), which
+#       flamegraph.pl and speedscope read directly.  The request just waits
+#       while the other threads are sampled, so it needs a threaded worker
+#       (gunicorn --threads 2 or more), a sync worker would only sample itself.
+#
+#   X-Profile: pstats  (or collapsed)  header on any request
+#       profiles just that request and returns the profile instead of the
+#       normal response (the real status is in X-Profile-Status)
+#
+# Both need the profile:worker permission.  With PROFILING_ENABLED off (the
+# default) none of this is registered at all, so it costs nothing.
+
+log = logging.getLogger(__name__)
+
+PERMISSION = 'profile:worker'
+
+
+def frame_label(frame):
+    return f"{frame.f_globals.get('__name__', '?')}.{frame.f_code.co_name}"
+
+
+def collapse(frame):
+    '''The stack from the outermost frame in, as "a;b;c"'''
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+class Sampler:
+    '''
+    Samples thread stacks from a background thread every interval seconds.
+    EXAMPLE
+        sampler = Sampler().start()
+        ...
+        print(sampler.stop().collapsed())
+    '''
+
+    def __init__(self, interval=0.005, thread_ids=None, ignore_ids=()):
+        self.interval = interval
+        self.thread_ids = thread_ids    # None = every thread
+        self.ignore_ids = set(ignore_ids)
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='profiler-sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self
+
+    def _run(self):
+        ignore = self.ignore_ids | {threading.get_ident()}
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in ignore or (self.thread_ids is not None and thread_id not in self.thread_ids):
+                    continue
+                self.stacks[collapse(frame)] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+def pstats_text(profile, limit=50):
+    stream = io.StringIO()
+    pstats.Stats(profile, stream=stream).sort_stats('cumulative').print_stats(limit)
+    return stream.getvalue()
+
+
+def check_profile_permission():
+    '''Same checks as @requires_auth(permission='profile:worker')'''
+    payload = verify_decode_jwt(get_token_auth_header())
+    check_permissions(PERMISSION, payload)
+
+
+def init_profiling(app):
+    '''
+    init_profiling(app)
+    Adds the profiling endpoint and header, if PROFILING_ENABLED
+    Config: PROFILING_ENABLED, PROFILE_MAX_SECONDS (longest /profile run)
+    '''
+    if not app.config.get('PROFILING_ENABLED', False):
+        return
+
+    max_seconds = app.config.get('PROFILE_MAX_SECONDS', 60)
+    busy = threading.Lock()     # One worker-wide profile at a time
+
+    @app.route('/profile', methods=['GET'])
+    def profile_worker():
+        check_profile_permission()
+
+        seconds = request.args.get('seconds', 10, type=float)
+        interval = request.args.get('interval', 0.005, type=float)
+        if not 0 < seconds <= max_seconds or not 0.001 <= interval <= 1:
+            abort(422)
+        if not request.environ.get('wsgi.multithread'):
+            # Nothing else can run in this worker while we wait, so there'd be nothing to sample
+            log.warning('GET /profile needs a threaded worker, e.g. gunicorn --threads 4')
+            abort(503)
+        if not busy.acquire(blocking=False):
+            abort(409)  # Already profiling
+
+        try:
+            # Don't sample this thread, it's just sleeping
+            sampler = Sampler(interval, ignore_ids=[threading.get_ident()]).start()
+            time.sleep(seconds)
+            sampler.stop()
+        finally:
+            busy.release()
+
+        response = Response(sampler.collapsed(), mimetype='text/plain')
+        response.headers['X-Profile-Samples'] = str(sampler.samples)
+        return response
+
+    @app.before_request
+    def start_request_profile():
+        kind = request.headers.get('X-Profile')
+        if not kind:
+            return
+        if kind not in ('pstats', 'collapsed'):
+            abort(400)
+        check_profile_permission()
+
+        if kind == 'pstats':
+            g.profile = cProfile.Profile()
+            g.profile.enable()
+        else:
+            g.profile = Sampler(0.001, thread_ids={threading.get_ident()}).start()
+
+    @app.after_request
+    def finish_request_profile(response):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return response
+
+        if isinstance(profile, Sampler):
+            body = profile.stop().collapsed()
+        else:
+            profile.disable()
+            body = pstats_text(profile)
+
+        profiled = Response(body, mimetype='text/plain')
+        profiled.headers['X-Profile-Status'] = str(response.status_code)
+        return profiled
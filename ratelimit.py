@@ -0,0 +1,202 @@
+import math
+import time
+import threading
+from flask import request, g, abort
+
+# Rate limiting with token buckets
+#
+# Every client gets a bucket per route, holding up to `capacity` tokens and
+# refilling at `rate` tokens per second.  A request takes one token, or gets a
+# 429 if the bucket is empty.  Runs in before_request, so a rejected request
+# never touches the database or the auth code.
+#
+# Config (see create_app):
+#   RATELIMIT_ENABLED       True/False
+#   RATELIMIT_DEFAULT       limit for routes not in RATELIMITS, e.g. '120/minute' (None = unlimited)
+#   RATELIMITS              {'<endpoint name>': '<limit>'}, e.g. {'get_companies': '30/minute'}
+#   RATELIMIT_KEY           'ip' (default) or 'sub' (verified JWT subject, falls back to ip)
+#   RATELIMIT_TRUST_PROXY   use the address added by the proxy in X-Forwarded-For (on by default on Heroku)
+#   RATELIMIT_STORAGE_URL   'memory://' (default, per process) or 'redis://host:port/db' (shared)
+
+PERIODS = {
+    'second': 1,
+    'minute': 60,
+    'hour': 60 * 60,
+    'day': 24 * 60 * 60
+}
+
+
+class Limit:
+    '''
+    A parsed limit like '60/minute' -> capacity 60, refilling 1 token/second
+    '''
+    __slots__ = ('capacity', 'rate')
+
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.rate = capacity / period   # tokens per second
+
+    @classmethod
+    def parse(cls, limit):
+        try:
+            count, period = limit.split('/')
+            return cls(int(count), PERIODS[period.strip().rstrip('s')])
+        except (ValueError, KeyError):
+            raise ValueError(f"Invalid rate limit '{limit}', expected something like '60/minute'")
+
+
+class MemoryStore:
+    '''
+    Token buckets kept in this worker process.
+
+    The key -> bucket dict is never locked (dict.setdefault is atomic), each
+    bucket has its own tiny lock, so clients never wait on each other.
+    '''
+
+    # Sweep out idle (full) buckets every this many hits so memory stays bounded
+    SWEEP_EVERY = 10000
+
+    def __init__(self):
+        self._buckets = {}
+        self._hits = 0
+
+    def hit(self, key, limit, now=None):
+        '''Takes a token. Returns (allowed, tokens_left)'''
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            # [tokens, last hit, lock, seconds to refill from empty]
+            bucket = self._buckets.setdefault(key, [limit.capacity, now, threading.Lock(), limit.capacity / limit.rate])
+
+        with bucket[2]:
+            tokens = min(limit.capacity, bucket[0] + (now - bucket[1]) * limit.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            bucket[0], bucket[1] = tokens, now
+
+        self._hits += 1
+        if self._hits % self.SWEEP_EVERY == 0:
+            self.sweep(now)
+
+        return allowed, tokens
+
+    def sweep(self, now):
+        # Anything idle long enough to have refilled is the same as a new bucket
+        for key, bucket in list(self._buckets.items()):
+            if now - bucket[1] > bucket[3]:
+                self._buckets.pop(key, None)
+
+
+class RedisStore:
+    '''
+    Token buckets shared by every worker through Redis (needs the redis package).
+    The whole take-a-token step runs as one Lua script so it's atomic.
+    '''
+
+    SCRIPT = '''
+        local capacity = tonumber(ARGV[1])
+        local rate = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+        local tokens = tonumber(bucket[1]) or capacity
+        local ts = tonumber(bucket[2]) or now
+        tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+        local allowed = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+            allowed = 1
+        end
+        redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+        return {allowed, tostring(tokens)}
+    '''
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("RATELIMIT_STORAGE_URL is redis:// but the redis package is not installed")
+        self._take = redis.Redis.from_url(url).register_script(self.SCRIPT)
+
+    def hit(self, key, limit, now=None):
+        now = time.time() if now is None else now
+        allowed, tokens = self._take(keys=['ratelimit:' + key], args=[limit.capacity, limit.rate, now])
+        return bool(allowed), float(tokens)
+
+
+def make_store(url):
+    if not url or url.startswith('memory://'):
+        return MemoryStore()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStore(url)
+    raise ValueError(f"Unsupported RATELIMIT_STORAGE_URL '{url}'")
+
+
+def client_ip(trust_proxy=False):
+    if trust_proxy and request.access_route:
+        # The right-most address is the one our own proxy saw, the rest can be faked
+        return request.access_route[-1]
+    return request.remote_addr
+
+
+def client_key(key_type='ip', trust_proxy=False):
+    '''
+    Who is this request from?  'sub' uses the JWT subject, but only once the
+    token has been verified, so a made-up sub can't get a fresh bucket.
+    Without a valid token it's the IP address.
+    '''
+    if key_type == 'sub':
+        from auth import get_verified_payload
+        sub = (get_verified_payload() or {}).get('sub')
+        if isinstance(sub, str) and sub:
+            return 'sub:' + sub
+    return 'ip:' + str(client_ip(trust_proxy))
+
+
+def init_rate_limits(app):
+    '''
+    init_rate_limits(app)
+    Registers the limiter on the app, limits come from app.config (see top of file)
+    '''
+    if not app.config.get('RATELIMIT_ENABLED', True):
+        return
+
+    default = app.config.get('RATELIMIT_DEFAULT')
+    default = Limit.parse(default) if default else None
+    limits = {endpoint: Limit.parse(limit) for endpoint, limit in (app.config.get('RATELIMITS') or {}).items()}
+    key_type = app.config.get('RATELIMIT_KEY', 'ip')
+    trust_proxy = app.config.get('RATELIMIT_TRUST_PROXY', False)
+    store = make_store(app.config.get('RATELIMIT_STORAGE_URL'))
+
+    @app.before_request
+    def check_rate_limit():
+        # CORS preflights and unknown routes don't cost anything
+        if request.method == 'OPTIONS' or request.endpoint is None:
+            return
+        limit = limits.get(request.endpoint, default)
+        if limit is None:
+            return
+
+        key = request.endpoint + ':' + client_key(key_type, trust_proxy)
+        allowed, tokens = store.hit(key, limit)
+        g.rate_limit = (limit, tokens)
+        if not allowed:
+            abort(429)
+
+    @app.after_request
+    def add_rate_limit_headers(response):
+        if 'rate_limit' not in g:
+            return response
+        limit, tokens = g.rate_limit
+        response.headers['RateLimit-Limit'] = str(limit.capacity)
+        response.headers['RateLimit-Remaining'] = str(int(tokens))
+        # Seconds until the bucket is full again
+        response.headers['RateLimit-Reset'] = str(math.ceil((limit.capacity - tokens) / limit.rate))
+        if response.status_code == 429:
+            # Seconds until there's one whole token
+            response.headers['Retry-After'] = str(max(1, math.ceil((1 - tokens) / limit.rate)))
+        return response
+
+    app.extensions['ratelimit'] = store
+    return store
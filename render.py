@@ -0,0 +1,120 @@
+import html
+import re
+import textwrap
+from functools import lru_cache
+
+from policy_template import compile_template
+
+# Render pipeline for policies
+#
+#   policy body --normalize()--> clean template --compile--> fill in company --> text --> format
+#
+# normalize() and compile_template() run once per distinct policy body, and the
+# finished output is cached per (body, company, format), so repeat renders are
+# a dict lookup.
+
+# format: mimetype of the response (json is the original JSON envelope)
+FORMATS = {
+    'json': 'application/json',
+    'text': 'text/plain',
+    'markdown': 'text/markdown',
+    'html': 'text/html',
+}
+
+RENDER_CACHE_SIZE = 1024
+
+_BLANK_LINES = re.compile(r'\n{3,}')
+_MARKDOWN_SPECIAL = re.compile(r'([\\`*_\[\]<>#])')
+# Only special at the start of a line: list items (-, +, 1. or 1)) and setext underlines (=, -)
+_MARKDOWN_LINE_START = re.compile(r'^(\s*\d+(?=[.)])|\s*(?=[-+=]))')
+
+# Longest line that can be a heading, anything longer is just shouting
+MAX_HEADING = 60
+
+
+@lru_cache(maxsize=256)
+def normalize(body):
+    '''
+    Strips the indentation left over from triple-quoted bodies (see pop_policies),
+    trailing spaces, and runs of blank lines
+    '''
+    text = textwrap.dedent(body).strip()
+    text = '\n'.join(line.rstrip() for line in text.splitlines())
+    return _BLANK_LINES.sub('\n\n', text)
+
+
+def is_heading(line):
+    return line.isupper() and len(line) <= MAX_HEADING and not line.endswith(('.', '!', '?'))
+
+
+def escape_markdown(line):
+    line = _MARKDOWN_SPECIAL.sub(r'\\\1', line)
+    return _MARKDOWN_LINE_START.sub(r'\1\\', line)    # Backslash goes just before the marker
+
+
+def blocks(text):
+    '''
+    Splits text into (kind, lines) blocks, kind is 'title', 'heading' or 'paragraph'.
+    A short one line block in all capitals, not ending like a sentence, is a
+    heading, the first one is the title.
+    '''
+    result = []
+    for block in text.split('\n\n'):
+        lines = block.split('\n')
+        if len(lines) == 1 and is_heading(lines[0]):
+            kind = 'heading' if result else 'title'
+        else:
+            kind = 'paragraph'
+        result.append((kind, lines))
+    return result
+
+
+def to_markdown(text):
+    out = []
+    for kind, lines in blocks(text):
+        lines = [escape_markdown(line) for line in lines]
+        if kind == 'title':
+            out.append('# ' + lines[0])
+        elif kind == 'heading':
+            out.append('## ' + lines[0])
+        else:
+            out.append('  \n'.join(lines))   # Two spaces = line break in markdown
+    return '\n\n'.join(out) + '\n'
+
+
+def to_html(text):
+    out = []
+    for kind, lines in blocks(text):
+        lines = [html.escape(line) for line in lines]
+        if kind == 'title':
+            out.append(f'<h1>{lines[0]}</h1>')
+        elif kind == 'heading':
+            out.append(f'<h2>{lines[0]}</h2>')
+        else:
+            out.append('<p>' + '<br>\n'.join(lines) + '</p>')
+    return '\n'.join(out) + '\n'
+
+
+FORMATTERS = {
+    'json': lambda text: text,
+    'text': lambda text: text + '\n',
+    'markdown': to_markdown,
+    'html': to_html,
+}
+
+
+def template(body):
+    '''The compiled template for a policy body, raises TemplateError if it isn't valid'''
+    return compile_template(normalize(body))
+
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def render(body, values, fmt='json'):
+    '''
+    render(policy.body, company.template_values(), 'html')
+    Returns the policy filled in for the company, in the given format (see FORMATS).
+    values is a tuple of (placeholder, value) pairs so it can be cached.
+    '''
+    # Fill in the placeholders ({COMPANY}, {WEBSITE}, ...) with real data
+    text = template(body).render(dict(values))
+    return FORMATTERS[fmt](text)
@@ -0,0 +1,201 @@
+import math
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import request, g, has_request_context
+from sqlalchemy import create_engine, event
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+
+# Read-replica routing
+#
+# Queries run inside replica_reads() (or a view decorated with
+# @reads_from_replica) go to one of the read replicas, everything else goes to
+# the primary DATABASE_URL.  Replicas are health checked every so often and
+# skipped while they're down.  A response to a request that committed a write
+# sets a short-lived cookie, and while a client sends it back its reads stay on
+# the primary, so it reads its own writes even if the replicas are lagging
+# (and other clients' reads aren't held up by its writes).
+#
+# Config (see create_app):
+#   DATABASE_REPLICA_URLS     comma separated database URLs, empty = no replicas
+#   REPLICA_HEALTH_INTERVAL   seconds between health checks of a replica
+#   REPLICA_STICKY_SECONDS    seconds a client's reads stay on the primary after its write
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+
+# Cookie holding when (unix time) a client's reads may go back to the replicas
+STICKY_COOKIE = 'primary_reads_until'
+
+
+@contextmanager
+def replica_reads():
+    '''
+    Queries in this block may be answered by a read replica
+    EXAMPLE
+        with replica_reads():
+            companies = Company.live().all()
+    '''
+    previous = getattr(_local, 'replica', False)
+    _local.replica = True
+    try:
+        yield
+    finally:
+        _local.replica = previous
+
+
+def sticky_to_primary():
+    '''Did this request's client write recently?  (see STICKY_COOKIE)'''
+    try:
+        return float(request.cookies.get(STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def read_target():
+    '''
+    'primary' or 'replica', where this request's reads_from_replica view reads.
+    Add it to single-flight keys, so a client that has to read its own writes
+    never gets a result read from a replica by someone else.
+    '''
+    return 'primary' if sticky_to_primary() else 'replica'
+
+
+def reads_from_replica(f):
+    '''
+    Decorator version of replica_reads() for read-only views.  Clients that
+    wrote in the last REPLICA_STICKY_SECONDS read from the primary instead.
+    '''
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if sticky_to_primary():
+            return f(*args, **kwargs)   # Read-your-writes, the replicas may not have it yet
+        with replica_reads():
+            return f(*args, **kwargs)
+    return wrapper
+
+
+class Replica:
+    __slots__ = ('url', 'engine', 'healthy', 'checked_at')
+
+    def __init__(self, url):
+        self.url = url
+        self.engine = create_engine(url, pool_pre_ping=True)
+        self.healthy = False
+        self.checked_at = None
+
+
+class ReplicaRouter:
+    def __init__(self, urls, health_interval=30, sticky_seconds=5):
+        self.replicas = [Replica(url) for url in urls]
+        self.health_interval = health_interval
+        self.sticky_seconds = sticky_seconds
+        self._next = 0
+        self._check_lock = threading.Lock()
+
+    def pick(self):
+        '''
+        Returns the engine of a healthy replica (round robin), or None to use the primary
+        '''
+        now = time.monotonic()
+        for _ in range(len(self.replicas)):
+            self._next = (self._next + 1) % len(self.replicas)
+            replica = self.replicas[self._next]
+            if self.is_healthy(replica, now):
+                return replica.engine
+        return None
+
+    def is_healthy(self, replica, now):
+        due = replica.checked_at is None or now - replica.checked_at >= self.health_interval
+        # Only one thread runs a check, the others go with the last result
+        if due and self._check_lock.acquire(blocking=False):
+            try:
+                self.check(replica, now)
+            finally:
+                self._check_lock.release()
+        return replica.healthy
+
+    def check(self, replica, now=None):
+        try:
+            with replica.engine.connect() as conn:
+                conn.execute('SELECT 1')
+            replica.healthy = True
+        except Exception as e:
+            if replica.healthy or replica.checked_at is None:
+                log.warning('Exception in replica health check, using primary: %s', e)
+            replica.healthy = False
+        replica.checked_at = time.monotonic() if now is None else now
+        return replica.healthy
+
+
+class RoutingSession(SignallingSession):
+    '''
+    Session that sends reads inside replica_reads() to a replica.
+    Anything with pending changes, and anything during a flush, stays on the primary.
+    '''
+
+    def __init__(self, db, **options):
+        super().__init__(db, **options)
+        self._wrote = False
+        event.listen(self, 'after_flush', self._after_flush)
+        event.listen(self, 'after_commit', self._after_commit)
+
+    def get_bind(self, mapper=None, clause=None):
+        router = self.app.extensions.get('replicas')
+        if router and getattr(_local, 'replica', False) and not self._flushing \
+                and not (self.new or self.dirty or self.deleted):
+            engine = router.pick()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+    @staticmethod
+    def _after_flush(session, flush_context):
+        session._wrote = True
+
+    @staticmethod
+    def _after_commit(session):
+        if session._wrote:
+            session._wrote = False
+            if has_request_context():
+                g.wrote_primary = True    # See stick_to_primary() in init_replicas
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        from sqlalchemy import orm
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def init_replicas(app):
+    '''
+    init_replicas(app)
+    Sets up the replica router from app.config, if any replicas are configured
+    '''
+    urls = app.config.get('DATABASE_REPLICA_URLS') or []
+    if isinstance(urls, str):
+        urls = [url.strip() for url in urls.split(',') if url.strip()]
+    if not urls:
+        app.extensions.pop('replicas', None)
+        return None
+
+    router = ReplicaRouter(
+        urls,
+        health_interval=app.config.get('REPLICA_HEALTH_INTERVAL', 30),
+        sticky_seconds=app.config.get('REPLICA_STICKY_SECONDS', 5)
+    )
+    app.extensions['replicas'] = router
+
+    @app.after_request
+    def stick_to_primary(response):
+        # This request committed a write, keep the client on the primary for a bit
+        if g.pop('wrote_primary', False) and router.sticky_seconds > 0:
+            response.set_cookie(STICKY_COOKIE, str(math.ceil(time.time() + router.sticky_seconds)),
+                                max_age=math.ceil(router.sticky_seconds), httponly=True, samesite='Lax')
+        return response
+
+    return router
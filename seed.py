@@ -0,0 +1,173 @@
+import io
+import csv
+import json
+import time
+import random
+from datetime import date, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, unit_of_work, DEFAULT_TENANT, Company, Policy
+from render import template
+
+# Bulk loading for big fixture datasets (see manage.py seed / import)
+#
+# Rows are streamed in batches, one transaction per batch.  On Postgres each
+# batch is written with COPY, everywhere else (SQLite) with one executemany.
+# Neither goes through the ORM, so a million rows takes seconds, not hours.
+
+# Columns that can be loaded for each model.  The first ones are required.
+# Rows without a tenant_id go in the tenant given to load().
+COLUMNS = {
+    'company': (Company, ['name', 'website'], ['contact_email', 'jurisdiction', 'effective_date', 'tenant_id']),
+    'policy': (Policy, ['name', 'body'], ['tenant_id']),
+}
+
+# Building blocks for synthetic companies
+_ADJECTIVES = ['Green', 'Blue', 'Quantum', 'Rapid', 'Silent', 'Golden', 'Lucky', 'Iron', 'Bright', 'Happy',
+               'Atomic', 'Cosmic', 'Honest', 'Clever', 'Brave', 'Little', 'Grand', 'Modern', 'Royal', 'Urban']
+_NOUNS = ['Cola', 'Data', 'Robot', 'Bakery', 'Labs', 'Motors', 'Apps', 'Foods', 'Cloud', 'Studio',
+          'Games', 'Health', 'Energy', 'Media', 'Systems', 'Garden', 'Logistics', 'Bank', 'Books', 'Pets']
+_SUFFIXES = ['Inc.', 'LLC', 'Ltd.', 'Co.', 'Corp.', 'GmbH', 'Group', 'Partners']
+_JURISDICTIONS = ['the State of Oregon', 'the State of California', 'the State of New York',
+                  'the State of Delaware', 'England and Wales', 'Ontario, Canada', None]
+
+
+def synthetic_companies(count, seed=0, start=0):
+    '''
+    Generates count fake companies as dicts.  The same seed always gives the same
+    companies, and names/websites are unique (they include the row number).
+    '''
+    rng = random.Random(seed)
+    first_day = date(2015, 1, 1)
+    for i in range(start, start + count):
+        adjective, noun, suffix = rng.choice(_ADJECTIVES), rng.choice(_NOUNS), rng.choice(_SUFFIXES)
+        slug = f'{adjective}{noun}{i}'.lower()
+        yield {
+            'name': f'{adjective} {noun} {i} {suffix}',
+            'website': f'{slug}.example.com',
+            'contact_email': f'legal@{slug}.example.com' if rng.random() < 0.8 else None,
+            'jurisdiction': rng.choice(_JURISDICTIONS),
+            'effective_date': first_day + timedelta(days=rng.randrange(3650)) if rng.random() < 0.7 else None,
+        }
+
+
+def read_csv(stream):
+    '''Rows from a CSV file with a header line, empty cells are None'''
+    for row in csv.DictReader(stream):
+        yield {key: value if value != '' else None for key, value in row.items()}
+
+
+def read_ndjson(stream):
+    '''Rows from a file with one JSON object per line'''
+    for line_number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            raise ValueError(f'Line {line_number} is not valid JSON: {e}')
+        if not isinstance(row, dict):
+            raise ValueError(f'Line {line_number} is not a JSON object')
+        yield row
+
+
+READERS = {
+    'csv': read_csv,
+    'ndjson': read_ndjson,
+}
+
+
+def clean_row(model, row, row_number, tenant_id=DEFAULT_TENANT):
+    '''
+    Checks a row has what the model needs and converts its values, or raises ValueError
+    '''
+    _, required, optional = COLUMNS[model]
+    missing = [column for column in required if not row.get(column)]
+    if missing:
+        raise ValueError(f"Row {row_number} is missing {', '.join(missing)}")
+
+    cleaned = {column: row.get(column) for column in required + optional}
+    for column in required:
+        cleaned[column] = str(cleaned[column]).strip()
+    # Bulk inserts skip column defaults, so fill it in here
+    cleaned['tenant_id'] = cleaned['tenant_id'] or tenant_id
+
+    if isinstance(cleaned.get('effective_date'), str):
+        try:
+            cleaned['effective_date'] = date.fromisoformat(cleaned['effective_date'])
+        except ValueError:
+            raise ValueError(f"Row {row_number} has an effective_date that isn't YYYY-MM-DD")
+    if model == 'policy':
+        # COPY skips the model's validator, so compile the template here instead
+        try:
+            template(cleaned['body'])
+        except ValueError as e:
+            raise ValueError(f'Row {row_number} has an invalid body: {e}')
+    return cleaned
+
+
+def batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _copy(session, table, columns, batch):
+    '''Writes a batch with Postgres COPY, as CSV through an in-memory buffer'''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in batch:
+        # None -> empty unquoted field, which COPY's CSV format reads as NULL
+        writer.writerow(['' if row[column] is None else row[column] for column in columns])
+    buffer.seek(0)
+
+    cursor = session.connection().connection.cursor()
+    quoted_columns = ', '.join(f'"{column}"' for column in columns)
+    cursor.copy_expert(f'COPY "{table.name}" ({quoted_columns}) FROM STDIN WITH (FORMAT csv)', buffer)
+
+
+def load(model, rows, batch_size=5000, progress=None, tenant_id=DEFAULT_TENANT):
+    '''
+    load('company', rows, batch_size=5000, progress=print)
+    Writes the rows (dicts) to the model's table in batches, one transaction each,
+    in tenant_id unless a row has its own.
+    progress(message) is called after every batch.  Returns (rows written, seconds).
+    Raises ValueError for a bad row, the batches before it are already saved.
+    '''
+    table = COLUMNS[model][0].__table__
+    _, required, optional = COLUMNS[model]
+    columns = required + optional
+    use_copy = db.engine.dialect.name == 'postgresql'
+    # COPY goes through the raw psycopg2 cursor, so its errors aren't SQLAlchemy's
+    duplicate_errors = (IntegrityError, getattr(db.engine.dialect.dbapi, 'IntegrityError', IntegrityError))
+
+    cleaned = (clean_row(model, row, row_number, tenant_id) for row_number, row in enumerate(rows, 1))
+
+    total = 0
+    started = time.perf_counter()
+    for batch in batches(cleaned, batch_size):
+        try:
+            with unit_of_work() as session:
+                if use_copy:
+                    _copy(session, table, columns, batch)
+                else:
+                    session.execute(table.insert(), batch)   # executemany
+        except duplicate_errors as e:
+            # The database doesn't say which row of the batch, but its message has the values
+            rows = f'Row {total + 1}' if len(batch) == 1 else f'Rows {total + 1}-{total + len(batch)}'
+            reason = ' '.join(str(getattr(e, 'orig', e)).split())
+            raise ValueError(f'{rows} clash with rows already there (duplicate name or website?): {reason}')
+        total += len(batch)
+
+        if progress:
+            elapsed = time.perf_counter() - started
+            progress(f'{total} {model} rows, {total / elapsed:,.0f} rows/sec')
+
+    return total, time.perf_counter() - started
@@ -8,6 +8,10 @@ export CLIENT_APP_ID=##
 export CLIENT_TOKEN=##
 export ADMIN_TOKEN=##
 
+# Offline instead of Auth0: python manage.py keygen, then uncomment this and
+# mint the tokens above with python manage.py token --role client|admin
+# export AUTH_JWKS_FILE=local_jwks.json
+
 export DATABASE_URL=postgres://postgres:a@localhost:5432/roboterms
 
 export FLASK_APP=app.py
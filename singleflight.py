@@ -0,0 +1,109 @@
+import threading
+
+# Request coalescing ("single-flight")
+#
+# When several threads ask for the same key at the same time, only the first
+# one (the leader) runs the function.  The rest wait for it and get the same
+# result, or the same exception.  Nothing is cached: once the leader is done
+# the next caller runs the function again.
+#
+# EXAMPLE
+#     reads = SingleFlight(timeout=10)
+#     data = reads.do('companies', company_list)
+
+
+class SingleFlightTimeout(Exception):
+    '''Raised in a waiting thread when the leader took longer than the timeout'''
+    def __init__(self, key):
+        super().__init__(f"Timed out waiting for in-flight call '{key}'")
+        self.key = key
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self, timeout=None):
+        self.timeout = timeout  # seconds a waiting thread will wait, None = forever
+        self._lock = threading.Lock()
+        self._calls = {}
+
+        # Metrics
+        self.calls = 0       # every do()
+        self.executed = 0    # calls that actually ran the function
+        self.coalesced = 0   # calls that shared another call's result
+        self.timeouts = 0
+        self.errors = 0
+
+    def do(self, key, fn, timeout=None):
+        '''
+        do(key, fn)
+        Returns fn(), sharing one in-flight call between concurrent callers of the same key
+        '''
+        with self._lock:
+            self.calls += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return self._wait(key, call, self.timeout if timeout is None else timeout)
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                # forget() may already have dropped it, don't remove a newer call
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+
+        return call.result
+
+    def _wait(self, key, call, timeout):
+        if not call.done.wait(timeout):
+            with self._lock:
+                self.timeouts += 1
+            raise SingleFlightTimeout(key)
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def forget(self, key=None):
+        '''
+        forget(key)
+        Callers arriving after this start a new call instead of joining the one
+        in flight.  Used after writes so nobody gets data read before the write.
+        key=None forgets everything.
+        '''
+        with self._lock:
+            if key is None:
+                self._calls.clear()
+            else:
+                self._calls.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "executed": self.executed,
+                "coalesced": self.coalesced,
+                "timeouts": self.timeouts,
+                "errors": self.errors,
+                "in_flight": len(self._calls)
+            }
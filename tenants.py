@@ -0,0 +1,164 @@
+import re
+import time
+import threading
+from collections import namedtuple, OrderedDict
+from types import MappingProxyType
+from flask import current_app, request, abort
+
+from auth import AuthError
+from models import DEFAULT_TENANT, Company, Policy
+from render import render
+
+# Tenants and their policy catalogs
+#
+# Every company and policy belongs to a tenant (a customer or reseller), and
+# each tenant has its own catalog of policies.  Writes go to the tenant in the
+# token's TENANT_CLAIM claim; public reads pick one with ?tenant= (default
+# DEFAULT_TENANT).
+#
+# Each worker keeps an immutable snapshot of every tenant's catalog it has been
+# asked for, so renders and GET /policies never query the Policy table.  An
+# edit builds a new snapshot and swaps it in (one dict assignment), so readers
+# see either the old catalog or the new one, never half of each.  Edits made
+# through other workers show up once a snapshot is CATALOG_MAX_AGE seconds old
+# and gets reloaded.  Empty catalogs aren't kept, so asking for made-up tenant
+# ids can't push real tenants out.
+#
+# Config (see create_app):
+#   TENANT_CLAIM          JWT claim holding the tenant id ('org_id' with Auth0 Organizations)
+#   CATALOG_MAX_AGE       seconds before a snapshot is reloaded from the database
+#   CATALOG_MAX_TENANTS   snapshots kept per worker, least recently used go first
+
+TENANT_ID = re.compile(r'^[A-Za-z0-9_.|-]{1,64}$')
+
+
+def tenant_from_claims(payload):
+    '''
+    The tenant of a verified token (see requires_auth): its TENANT_CLAIM claim,
+    or DEFAULT_TENANT if it hasn't got one
+    '''
+    tenant_id = payload.get(current_app.config.get('TENANT_CLAIM', 'org_id')) or DEFAULT_TENANT
+    if not isinstance(tenant_id, str) or not TENANT_ID.match(tenant_id):
+        raise AuthError({
+            'code': 'invalid_claims',
+            'description': 'Invalid tenant claim.'
+        }, 401)
+    return tenant_id
+
+
+def requested_tenant():
+    '''The tenant a public read asks for with ?tenant=, DEFAULT_TENANT if none'''
+    tenant_id = request.args.get('tenant', DEFAULT_TENANT)
+    if not TENANT_ID.match(tenant_id):
+        abort(400)
+    return tenant_id
+
+
+PolicyEntry = namedtuple('PolicyEntry', ['id', 'name', 'body'])
+
+
+class Catalog:
+    '''
+    Snapshot of one tenant's policies.  Never changed after it's made, only replaced.
+    '''
+    __slots__ = ('tenant_id', 'policies', 'by_id', 'loaded_at')
+
+    def __init__(self, tenant_id, policies):
+        self.tenant_id = tenant_id
+        self.policies = tuple(policies)
+        self.by_id = MappingProxyType({policy.id: policy for policy in self.policies})
+        self.loaded_at = time.monotonic()
+
+    def get(self, policy_id):
+        return self.by_id.get(policy_id)
+
+    def as_list(self):
+        '''Same as GET /policies has always returned'''
+        return [policy._asdict() for policy in self.policies]
+
+
+def load_catalog(tenant_id):
+    policies = Policy.query.filter(Policy.tenant_id == tenant_id).order_by(Policy.id)
+    return Catalog(tenant_id, [PolicyEntry(pol.id, pol.name, pol.body) for pol in policies])
+
+
+class CatalogStore:
+    '''
+    The catalog snapshots of one worker, by tenant
+    EXAMPLE
+        catalogs = CatalogStore(max_age=10)
+        policy = catalogs.get('default').get(policy_id)
+        ...
+        catalogs.reload('default')     # after committing an edit
+    '''
+
+    def __init__(self, max_age=10, max_tenants=1000):
+        self.max_age = max_age
+        self.max_tenants = max_tenants
+        self._catalogs = OrderedDict()  # tenant_id: catalog, least recently used first
+        self._locks = {}    # tenant_id: lock held while loading its catalog
+
+    def get(self, tenant_id):
+        '''The tenant's current catalog, loading it if it's missing or too old'''
+        catalog = self._catalogs.get(tenant_id)
+        if catalog is not None:
+            try:
+                self._catalogs.move_to_end(tenant_id)
+            except KeyError:
+                pass    # Evicted by another thread just now
+            if time.monotonic() - catalog.loaded_at < self.max_age:
+                return catalog
+
+        # One thread reloads, while the others carry on with the old snapshot
+        # (or, the first time, wait for it)
+        lock = self._locks.setdefault(tenant_id, threading.Lock())
+        if not lock.acquire(blocking=catalog is None):
+            return catalog
+        try:
+            current = self._catalogs.get(tenant_id)
+            if current is not None and current is not catalog:
+                return current  # Somebody else just loaded it
+            return self._swap(load_catalog(tenant_id))
+        finally:
+            lock.release()
+
+    def reload(self, tenant_id):
+        '''Loads the tenant's catalog again right now, e.g. after an edit'''
+        lock = self._locks.setdefault(tenant_id, threading.Lock())
+        with lock:
+            return self._swap(load_catalog(tenant_id))
+
+    def _swap(self, catalog):
+        if not catalog.policies:
+            # No such tenant (or nothing in it yet), don't give it a slot
+            self._catalogs.pop(catalog.tenant_id, None)
+            self._locks.pop(catalog.tenant_id, None)
+            return catalog
+
+        self._catalogs[catalog.tenant_id] = catalog
+        self._catalogs.move_to_end(catalog.tenant_id)
+        while len(self._catalogs) > self.max_tenants:
+            # Too many tenants, forget whichever was used longest ago
+            try:
+                oldest, _ = self._catalogs.popitem(last=False)
+            except KeyError:
+                break
+            self._locks.pop(oldest, None)
+        return catalog
+
+
+def render_policy(catalogs, company_id, policy_id, fmt='json'):
+    '''
+    Returns the policy rendered for the company in format fmt (see render.py),
+    or None if either doesn't exist.  The policy comes from the company's
+    tenant's catalog snapshot, so only the company is queried.
+    '''
+    company = Company.get_live(company_id)
+    if not company:
+        return None
+
+    policy = catalogs.get(company.tenant_id).get(policy_id)
+    if not policy:
+        return None
+
+    return render(policy.body, company.template_values(), fmt)
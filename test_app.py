@@ -1,10 +1,31 @@
 import os
+import sys
+import time
+import threading
+import subprocess
 import unittest
+import io
 import json
+import logging
+import tempfile
+import sqlite3
+from unittest import mock
+from datetime import date, datetime, timedelta
+from sqlalchemy import create_engine, event
 from flask_sqlalchemy import SQLAlchemy
 
 from app import create_app
-from models import Company, Policy
+from models import db, unit_of_work, pop_policies, pop_mock_companies, purge_deleted, Company, Policy
+from singleflight import SingleFlight, SingleFlightTimeout
+from policy_template import compile_template, TemplateError
+import seed
+import logs
+import profiler
+import auth
+import tokens
+import tenants
+import render
+import replicas
 
 
 class RoboTermsTestsCase(unittest.TestCase):
@@ -113,6 +134,31 @@ class RoboTermsTestsCase(unittest.TestCase):
         self.assertEqual("TERMS OF SERVICE" in data['policy'], True)
         self.assertEqual("gcola.com" in data['policy'], True)
 
+    def test_get_rendered_policy_html(self):
+        """Gets a rendered policy as HTML, ready to embed."""
+        res = self.client().get('/rendered_policy/1/1?format=html')
+        
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/html')
+        self.assertIn("<h1>TERMS OF SERVICE</h1>", res.get_data(as_text=True))
+        self.assertIn("gcola.com", res.get_data(as_text=True))
+
+    def test_get_rendered_policy_text(self):
+        """Gets a rendered policy as plain text without the indentation from the boilerplate."""
+        res = self.client().get('/rendered_policy/1/1?format=text')
+        
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/plain')
+        self.assertTrue(res.get_data(as_text=True).startswith("TERMS OF SERVICE\n\nThese Terms"))
+
+    def test_get_rendered_policy_invalid_format(self):
+        """Attempts to get a rendered policy in a format that isn't supported."""
+        res = self.client().get('/rendered_policy/1/1?format=docx')
+        data = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
     def test_get_rendered_policy_invalid_company(self):
         """Attempts to get the rendered policy for an invalid company id."""
         res = self.client().get('/rendered_policy/1000/1')
@@ -138,7 +184,34 @@ class RoboTermsTestsCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         
         # Delete the company we added directly through the DB session
-        Company.query.get(data['id']).delete()
+        Company.query.get(data['id']).purge()
+
+    def test_post_bulk_companies(self):
+        """Creates several companies in one request as Client."""
+        new_cos = {"companies": [
+            {"name": "Bulk One", "website": "bulkone.com"},
+            {"name": "Bulk Two", "website": "bulktwo.com"}
+        ]}
+        res = self.client().post('/company/bulk', headers=self.headers_client, json=new_cos)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['ids']), 2)
+
+        for co_id in data['ids']:
+            Company.query.get(co_id).purge()
+
+    def test_post_bulk_companies_with_duplicate(self):
+        """A bulk request with one existing company creates none of them."""
+        new_cos = {"companies": [
+            {"name": "Bulk One", "website": "bulkone.com"},
+            {"name": "Spy App Inc.", "website": "spyonyourlovedones--butlovingly.com"}
+        ]}
+        res = self.client().post('/company/bulk', headers=self.headers_client, json=new_cos)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertIsNone(Company.live().filter_by(name="Bulk One").one_or_none())
 
     def test_post_new_company_without_token(self):
         """Attempts to create a new company without a token."""
@@ -179,7 +252,7 @@ class RoboTermsTestsCase(unittest.TestCase):
         new_co_id = new_co.id
 
         # Make sure it added successfully
-        all_companies = Company.query.all()
+        all_companies = Company.live().all()
         self.assertEqual(len(all_companies), 4)    # 3 originally in test DB
 
         # Delete it through route
@@ -190,6 +263,13 @@ class RoboTermsTestsCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(data['id'], new_co_id)
 
+        # Soft deleted: gone from every read, but the row is still there until purged
+        self.assertEqual(len(Company.live().all()), 3)
+        self.assertEqual(self.client().delete(f'/company/{new_co_id}', headers=self.headers_client).status_code, 404)
+        goner_co = Company.query.get(new_co_id)
+        self.assertIsNotNone(goner_co.deleted_at)
+        goner_co.purge()
+
     def test_delete_nonexistent_company(self):
         """Attempts to delete a company that doesn't exist."""
         res = self.client().delete(f'/company/1000', headers=self.headers_client)
@@ -253,6 +333,18 @@ class RoboTermsTestsCase(unittest.TestCase):
                 break
         self.assertEqual(updated_name, "Terms of Service")
 
+    def test_update_policy_malformed_body(self):
+        """Attempts to update a policy with a body that isn't a valid template."""
+        res = self.client().patch('/policy/1', headers=self.headers_admin, json={"body": "Hello {COMPANY"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)  # Rejected when saved, not when rendered
+        self.assertEqual(data['success'], False)
+
+        # The policy still renders fine
+        res = self.client().get('/rendered_policy/1/1')
+        self.assertEqual(res.status_code, 200)
+
     def test_update_nonexistent_policy(self):
         """Attempts to update a policy that doesn't exist."""
         res = self.client().patch('/policy/1000', headers=self.headers_admin, json={"name": "FOOBAZ"})
@@ -298,6 +390,958 @@ class RoboTermsTestsCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
     
 
+class StartupTestCase(unittest.TestCase):
+    """Guards cold start: importing the app must stay cheap"""
+
+    def test_import_is_lazy(self):
+        """Imports app in a clean interpreter and checks heavy modules didn't load."""
+        env = {k: v for k, v in os.environ.items()
+               if k not in ['DATABASE_URL', 'AUTH0_DOMAIN', 'ALGORITHMS', 'API_AUDIENCE']}
+        code = "import sys, app; print(','.join(sorted(m for m in sys.modules if '.' not in m)))"
+        res = subprocess.run([sys.executable, '-c', code], env=env, stdout=subprocess.PIPE,
+                             universal_newlines=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+        # Env vars missing shouldn't matter until create_app() is called
+        self.assertEqual(res.returncode, 0)
+        loaded = res.stdout.strip().split(',')
+        for module in ['markdown', 'pygments', 'jose', 'Crypto']:
+            self.assertNotIn(module, loaded)
+
+    def test_create_app_uses_test_config(self):
+        """create_app(test_config) overrides the environment."""
+        app = create_app({"DATABASE_URL": "sqlite://", "API_AUDIENCE": "test-audience"})
+
+        self.assertEqual(app.config["SQLALCHEMY_DATABASE_URI"], "sqlite://")
+        self.assertEqual(app.config["API_AUDIENCE"], "test-audience")
+
+
+class RateLimitTestCase(unittest.TestCase):
+    """Rate limiting, against a throwaway SQLite database"""
+
+    def setUp(self):
+        self.app = create_app({
+            "DATABASE_URL": "sqlite://",
+            "RATELIMIT_DEFAULT": None,
+            "RATELIMITS": {"get_policies": "2/minute"},
+        })
+        self.client = self.app.test_client
+        with self.app.app_context():
+            db.create_all()
+
+    def test_rate_limit_headers(self):
+        """Limited routes report how much of the limit is left."""
+        res = self.client().get('/policies')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['RateLimit-Limit'], '2')
+        self.assertEqual(res.headers['RateLimit-Remaining'], '1')
+
+    def test_rate_limit_exceeded(self):
+        """Going over the limit returns 429 with Retry-After."""
+        self.client().get('/policies')
+        self.client().get('/policies')
+        res = self.client().get('/policies')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(res.headers['RateLimit-Remaining'], '0')
+        self.assertGreaterEqual(int(res.headers['Retry-After']), 1)
+
+    def test_unlimited_route(self):
+        """Routes without a limit (and no default) send no headers."""
+        res = self.client().get('/companies')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('RateLimit-Limit', res.headers)
+
+    def sub_app(self):
+        app = create_app({
+            "DATABASE_URL": "sqlite://",
+            "RATELIMIT_DEFAULT": None,
+            "RATELIMITS": {"get_policies": "1/minute"},
+            "RATELIMIT_KEY": "sub",
+        })
+        with app.app_context():
+            db.create_all()
+        return app.test_client
+
+    def test_forged_sub_is_limited_by_ip(self):
+        """Tokens that don't verify can't escape the limit with a new sub each time."""
+        client = self.sub_app()
+        invalid = auth.AuthError({'code': 'invalid_token', 'description': ''}, 401)
+        with mock.patch('auth.verify_decode_jwt', side_effect=invalid):
+            first = client().get('/policies', headers={'Authorization': 'Bearer forged-1'})
+            second = client().get('/policies', headers={'Authorization': 'Bearer forged-2'})
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 429)
+
+    def test_verified_sub_gets_own_bucket(self):
+        """A verified token is limited by its sub, not the shared IP."""
+        client = self.sub_app()
+        client().get('/policies')
+        with mock.patch('auth.verify_decode_jwt', return_value={"sub": "user|1"}):
+            res = client().get('/policies', headers={'Authorization': 'Bearer good'})
+
+        self.assertEqual(res.status_code, 200)
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    """Request coalescing for concurrent identical reads"""
+
+    def run_concurrently(self, reads, fn, count=5):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.call(reads, fn)))
+                   for _ in range(count)]
+        for t in threads:
+            t.start()
+        return threads, results
+
+    def call(self, reads, fn):
+        try:
+            return reads.do('key', fn)
+        except Exception as e:
+            return e
+
+    def test_concurrent_calls_share_result(self):
+        """Only one of several concurrent calls runs the function."""
+        reads = SingleFlight(timeout=5)
+        release = threading.Event()
+        runs = []
+
+        def slow():
+            runs.append(1)
+            release.wait(5)
+            return {"answer": 42}
+
+        threads, results = self.run_concurrently(reads, slow)
+        while reads.stats()['calls'] < 5:
+            time.sleep(0.01)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(results, [{"answer": 42}] * 5)
+        self.assertEqual(reads.stats()['coalesced'], 4)
+
+    def test_error_is_shared(self):
+        """Waiting calls get the leader's exception."""
+        reads = SingleFlight(timeout=5)
+        release = threading.Event()
+
+        def broken():
+            release.wait(5)
+            raise ValueError("boom")
+
+        threads, results = self.run_concurrently(reads, broken, count=3)
+        while reads.stats()['calls'] < 3:
+            time.sleep(0.01)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+        self.assertEqual(reads.stats()['executed'], 1)
+
+    def test_timeout(self):
+        """A waiting call gives up after the timeout."""
+        reads = SingleFlight(timeout=0.05)
+        release = threading.Event()
+
+        threads, results = self.run_concurrently(reads, lambda: release.wait(5), count=2)
+        while reads.stats()['timeouts'] < 1:
+            time.sleep(0.01)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertTrue(any(isinstance(r, SingleFlightTimeout) for r in results))
+
+
+class ReplicaTestCase(unittest.TestCase):
+    """Read-replica routing, with two SQLite files standing in for primary and replica"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        primary_url = f"sqlite:///{self.tmp.name}/primary.db"
+        replica_url = f"sqlite:///{self.tmp.name}/replica.db"
+
+        self.app = create_app({
+            "DATABASE_URL": primary_url,
+            "DATABASE_REPLICA_URLS": replica_url,
+            "RATELIMIT_ENABLED": False,
+        })
+        self.client = self.app.test_client
+        self.router = self.app.extensions['replicas']
+
+        # Same schema in both, but different rows so we can tell who answered
+        with self.app.app_context():
+            db.create_all()
+            Company(name="Primary Co", website="primary.com").insert()
+        replica = self.router.replicas[0].engine
+        db.Model.metadata.create_all(replica)
+        replica.execute(Company.__table__.insert(), name="Replica Co", website="replica.com")
+
+    def tearDown(self):
+        for replica in self.router.replicas:
+            replica.engine.dispose()
+        self.tmp.cleanup()
+
+    def company_names(self, client=None):
+        data = json.loads((client or self.client()).get('/companies').data)
+        return [co['name'] for co in data['companies']]
+
+    def test_reads_go_to_replica(self):
+        """GET /companies is answered by the replica."""
+        self.assertEqual(self.company_names(), ["Replica Co"])
+
+    def test_read_your_writes(self):
+        """Right after a write, that client's reads stay on the primary, nobody else's."""
+        writer = self.client()
+        with mock.patch('auth.verify_decode_jwt', return_value={'sub': 'test|1', 'permissions': ['post:company']}):
+            res = writer.post('/company', json={"name": "New Co", "website": "new.com"},
+                              headers={'Authorization': 'Bearer token'})
+        self.assertEqual(res.status_code, 200)
+
+        self.assertEqual(self.company_names(writer), ["Primary Co", "New Co"])
+        self.assertEqual(self.company_names(), ["Replica Co"])
+
+    def test_sticky_read_not_shared_with_replica_read(self):
+        """A client reading its own writes doesn't join a read already running on a replica."""
+        import app as app_module
+        started, release = threading.Event(), threading.Event()
+        real_company_list = app_module.company_list
+
+        def slow_company_list(tenant_id):
+            if not started.is_set():
+                started.set()
+                release.wait(5)     # Still in flight when the sticky client asks
+            return real_company_list(tenant_id)
+
+        sticky = self.client()
+        sticky.set_cookie('localhost', replicas.STICKY_COOKIE, str(int(time.time()) + 60))
+        replica_names = []
+        with mock.patch('app.company_list', side_effect=slow_company_list):
+            reader = threading.Thread(target=lambda: replica_names.extend(self.company_names()))
+            reader.start()
+            started.wait(5)
+            threading.Timer(0.3, release.set).start()
+            sticky_names = self.company_names(sticky)
+            reader.join()
+
+        self.assertEqual(sticky_names, ["Primary Co"])
+        self.assertEqual(replica_names, ["Replica Co"])
+
+    def test_unhealthy_replica_falls_back(self):
+        """A replica that fails its health check isn't used."""
+        replica = self.router.replicas[0]
+        replica.engine = create_engine(f"sqlite:///{self.tmp.name}/no/such/dir.db")
+
+        self.assertEqual(self.company_names(), ["Primary Co"])
+        self.assertFalse(replica.healthy)
+
+
+class TemplateTestCase(unittest.TestCase):
+    """Compiling and filling in policy templates"""
+
+    def test_render(self):
+        """Placeholders are filled in and doubled braces are literal."""
+        template = compile_template("{COMPANY} ({WEBSITE}) uses {{braces}}, ask {CONTACT_EMAIL}")
+
+        self.assertEqual(template.render({"COMPANY": "ACME", "WEBSITE": "acme.com", "CONTACT_EMAIL": "a@acme.com"}),
+                         "ACME (acme.com) uses {braces}, ask a@acme.com")
+
+    def test_same_as_str_format(self):
+        """A valid body renders the same as the old str.format."""
+        body = "TERMS\n\n{COMPANY} runs {WEBSITE}.\nEffective {EFFECTIVE_DATE} under {JURISDICTION}."
+        values = {"COMPANY": "ACME", "WEBSITE": "acme.com", "EFFECTIVE_DATE": "June 1, 2020",
+                  "JURISDICTION": "Oregon", "CONTACT_EMAIL": ""}
+
+        self.assertEqual(compile_template(body).render(values), body.format(**values))
+
+    def test_missing_value_is_blank(self):
+        """Placeholders the company hasn't filled in are left blank."""
+        self.assertEqual(compile_template("[{JURISDICTION}]").render({}), "[]")
+
+    def test_malformed(self):
+        """Stray braces and unknown placeholders are errors."""
+        for body in ["Hello {COMPANY", "Hello }", "Hello {NOPE}", "{}"]:
+            with self.assertRaises(TemplateError):
+                compile_template(body)
+
+
+class RenderTestCase(unittest.TestCase):
+    """Turning rendered policies into markdown and HTML"""
+
+    def test_headings(self):
+        """Only short capitalised lines that don't end like a sentence are headings."""
+        text = "TERMS\n\nSECTION ONE\n\nWE ARE NOT LIABLE FOR ANYTHING.\n\n" + "SHOUTING " * 8
+        kinds = [kind for kind, lines in render.blocks(text)]
+
+        self.assertEqual(kinds, ['title', 'heading', 'paragraph', 'paragraph'])
+
+    def test_markdown_escapes_line_starts(self):
+        """Paragraphs that start like a list or an underline stay paragraphs."""
+        markdown = render.to_markdown("TERMS\n\n- not a list\n+ nor this\n1. nor this\n==\n\n2) Or *this*")
+
+        self.assertEqual(markdown, "# TERMS\n\n\\- not a list  \n\\+ nor this  \n1\\. nor this  \n\\==\n\n"
+                                   "2\\) Or \\*this\\*\n")
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """Base for tests against a throwaway SQLite database file, with the tables created"""
+
+    # Settings for create_app() on top of DATABASE_URL
+    test_config = {}
+
+    # Model tests get an app context for the whole test.  Tests that make
+    # requests turn it off, each request pushes its own (with its own g).
+    push_app_context = True
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.app = create_app(dict({"DATABASE_URL": f"sqlite:///{self.tmp.name}/test.db"}, **self.test_config))
+        self.client = self.app.test_client
+        if self.push_app_context:
+            self.ctx = self.app.app_context()
+            self.ctx.push()
+        with self.app.app_context():
+            db.create_all()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.get_engine(self.app).dispose()
+        if self.push_app_context:
+            self.ctx.pop()
+        self.tmp.cleanup()
+
+
+class UnitOfWorkTestCase(DatabaseTestCase):
+    """Grouping model operations into one transaction"""
+
+    def test_commits_once(self):
+        """Everything in the block is saved together at the end."""
+        commits = []
+        event.listen(db.session(), 'after_commit', lambda session: commits.append(1))
+
+        with unit_of_work():
+            Company(name="One", website="one.com").insert()
+            Company(name="Two", website="two.com").insert()
+            self.assertEqual(commits, [])
+
+        self.assertEqual(len(commits), 1)
+        self.assertEqual(len(Company.live().all()), 2)
+
+    def test_rolls_back_on_error(self):
+        """Nothing in the block is saved if it raises."""
+        with self.assertRaises(ValueError):
+            with unit_of_work():
+                Company(name="One", website="one.com").insert()
+                raise ValueError("boom")
+
+        self.assertEqual(Company.query.count(), 0)
+
+    def test_nested_savepoint(self):
+        """A failed inner block is undone without losing the outer one."""
+        with unit_of_work():
+            Company(name="Outer", website="outer.com").insert()
+            try:
+                with unit_of_work():
+                    Company(name="Inner", website="inner.com").insert()
+                    db.session.flush()
+                    raise ValueError("boom")
+            except ValueError:
+                pass
+
+        self.assertEqual([co.name for co in Company.query.all()], ["Outer"])
+
+    def test_seed(self):
+        """The seed functions run as one transaction each."""
+        pop_policies()
+        pop_mock_companies()
+
+        self.assertEqual(Policy.query.count(), 4)
+        self.assertEqual(Company.query.count(), 3)
+
+
+class PurgeTestCase(DatabaseTestCase):
+    """Soft deletes and purging them"""
+
+    def add_companies(self, count, deleted=False):
+        first = Company.query.count()
+        companies = [Company(name=f"Co {n}", website=f"co{n}.com") for n in range(first, first + count)]
+        with unit_of_work():
+            for company in companies:
+                if deleted:
+                    company.deleted_at = datetime.utcnow()
+                company.insert()
+        return [company.id for company in companies]
+
+    def test_soft_delete(self):
+        """A deleted company is hidden but kept, and its name can be used again."""
+        co_id = self.add_companies(1)[0]
+        Company.get_live(co_id).delete()
+
+        self.assertIsNone(Company.get_live(co_id))
+        self.assertEqual(Company.live().count(), 0)
+        self.assertIsNotNone(Company.query.get(co_id).deleted_at)
+
+        Company(name="Co 0", website="co0.com").insert()
+        self.assertEqual(Company.query.count(), 2)
+
+    def test_purge_in_batches(self):
+        """Deleted companies are removed batch_size at a time, live ones are left alone."""
+        self.add_companies(5, deleted=True)
+        live_ids = self.add_companies(2)
+
+        self.assertEqual(list(purge_deleted(batch_size=2)), [2, 2, 1])
+        self.assertEqual(sorted(co.id for co in Company.query.all()), live_ids)
+
+    def test_purge_older_than(self):
+        """Only companies deleted before the cutoff are purged."""
+        old_id, new_id = self.add_companies(2, deleted=True)
+        Company.query.get(old_id).deleted_at = datetime.utcnow() - timedelta(days=2)
+        Company.query.get(old_id).update()
+
+        self.assertEqual(list(purge_deleted(older_than=timedelta(days=1))), [1])
+        self.assertEqual([co.id for co in Company.query.all()], [new_id])
+
+
+class SeedTestCase(DatabaseTestCase):
+    """Bulk loading fixture data"""
+
+    def test_synthetic_is_deterministic(self):
+        """The same seed gives the same companies, with unique names."""
+        first = list(seed.synthetic_companies(500, seed=7))
+
+        self.assertEqual(first, list(seed.synthetic_companies(500, seed=7)))
+        self.assertEqual(len({co['name'] for co in first}), 500)
+        self.assertEqual(len({co['website'] for co in first}), 500)
+
+    def test_load_in_batches(self):
+        """Rows are written in batches with progress after each one."""
+        progress = []
+        total, _ = seed.load('company', seed.synthetic_companies(250), batch_size=100, progress=progress.append)
+
+        self.assertEqual(total, 250)
+        self.assertEqual(len(progress), 3)
+        self.assertEqual(Company.query.count(), 250)
+
+    def test_import_csv_and_ndjson(self):
+        """CSV and NDJSON rows are read and converted."""
+        csv_rows = seed.read_csv(io.StringIO("name,website,effective_date\nCSV Co,csv.com,2020-02-03\n"))
+        ndjson_rows = seed.read_ndjson(io.StringIO('{"name": "JSON Co", "website": "json.com"}\n'))
+        seed.load('company', csv_rows)
+        seed.load('company', ndjson_rows)
+
+        self.assertEqual(Company.query.filter_by(name="CSV Co").one().effective_date, date(2020, 2, 3))
+        self.assertIsNotNone(Company.query.filter_by(name="JSON Co").one_or_none())
+
+    def test_invalid_rows(self):
+        """Rows missing required columns, or with a broken policy body, are rejected."""
+        with self.assertRaises(ValueError):
+            seed.load('company', [{"name": "No Website"}])
+        with self.assertRaises(ValueError):
+            seed.load('policy', [{"name": "Broken", "body": "Hello {COMPANY"}])
+        with self.assertRaisesRegex(ValueError, 'Line 2 is not a JSON object'):
+            list(seed.read_ndjson(io.StringIO('{"name": "A", "website": "a.com"}\n["B", "b.com"]\n')))
+
+    def test_duplicates(self):
+        """A name that's already there stops the load with a ValueError naming the rows."""
+        seed.load('company', [{"name": "Dupe Co", "website": "dupe.com"}])
+
+        rows = [{"name": "New Co", "website": "new.com"}, {"name": "Dupe Co", "website": "other.com"}]
+        with self.assertRaisesRegex(ValueError, '^Rows 1-2 clash'):
+            seed.load('company', rows, batch_size=2)
+        self.assertEqual(Company.query.count(), 1)    # The whole batch was rolled back
+
+    def test_copy_duplicates(self):
+        """On Postgres COPY raises the driver's own IntegrityError, that's reported too."""
+        duplicate = sqlite3.IntegrityError('duplicate key value violates unique constraint "ix_company_name_live"')
+        with mock.patch.object(db.engine.dialect, 'name', 'postgresql'), \
+                mock.patch('seed._copy', side_effect=duplicate):
+            with self.assertRaisesRegex(ValueError, '^Row 1 clash.*ix_company_name_live'):
+                seed.load('company', [{"name": "Dupe Co", "website": "dupe.com"}])
+
+    def test_import_command_errors(self):
+        """manage.py import reports a missing file or a bad row instead of a traceback."""
+        path = os.path.join(self.tmp.name, 'rows.ndjson')
+        with open(path, 'w') as rows:
+            rows.write('"just a string"\n')
+        env = dict(os.environ, DATABASE_URL=self.app.config["DATABASE_URL"])
+
+        for args, message in [(['nowhere.csv'], 'Import stopped: [Errno 2]'),
+                              ([path], 'Import stopped: Line 1 is not a JSON object')]:
+            result = subprocess.run([sys.executable, 'manage.py', 'import'] + args, env=env,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)),
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            self.assertEqual(result.returncode, 1)
+            self.assertIn(message, result.stderr)
+
+
+class LoggingTestCase(unittest.TestCase):
+    """Request ids, and the slow request / slow query logs"""
+
+    def setUp(self):
+        self.app = create_app({
+            "DATABASE_URL": "sqlite://",
+            "RATELIMIT_ENABLED": False,
+            "SLOW_REQUEST_MS": 0,   # Everything is slow
+            "SLOW_QUERY_MS": 0,
+        })
+        self.client = self.app.test_client
+        with self.app.app_context():
+            db.create_all()
+
+    def tearDown(self):
+        logs._settings['slow_query_ms'] = 100     # Put the slow query threshold back
+
+    def test_request_id(self):
+        """Every response has an id, the caller's if they sent a sane one."""
+        res = self.client().get('/policies')
+        self.assertEqual(len(res.headers['X-Request-ID']), 32)
+
+        res = self.client().get('/policies', headers={'X-Request-ID': 'abc-123'})
+        self.assertEqual(res.headers['X-Request-ID'], 'abc-123')
+
+        res = self.client().get('/policies', headers={'X-Request-ID': 'no spaces please'})
+        self.assertNotEqual(res.headers['X-Request-ID'], 'no spaces please')
+
+    def test_slow_request_and_query(self):
+        """Slow requests and queries are logged with the request id and query count."""
+        with self.assertLogs('logs', level='WARNING') as captured:
+            res = self.client().get('/policies')
+
+        records = {record.getMessage(): record for record in captured.records}
+        self.assertEqual(records['slow request'].fields['path'], '/policies')
+        self.assertGreaterEqual(records['slow request'].fields['db_queries'], 1)
+        self.assertIn('SELECT', records['slow query'].fields['statement'])
+        self.assertEqual(records['slow query'].request_id, res.headers['X-Request-ID'])
+
+    def test_worker_stats(self):
+        """The coalescing counters are logged once the interval has passed."""
+        app = create_app({"DATABASE_URL": "sqlite://", "RATELIMIT_ENABLED": False, "STATS_LOG_INTERVAL": 0.05})
+        with app.app_context():
+            db.create_all()
+        app.test_client().get('/companies')
+        time.sleep(0.1)
+
+        with self.assertLogs('logs', level='INFO') as captured:
+            app.test_client().get('/companies')
+
+        stats = [record.fields for record in captured.records if record.getMessage() == 'worker stats']
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]['singleflight']['calls'], 2)
+
+    def test_json_lines(self):
+        """Log lines are JSON objects including the extra fields."""
+        record = logging.LogRecord('app', logging.WARNING, __file__, 1, 'hello %s', ('world',), None)
+        record.request_id = 'abc'
+        record.fields = {'status': 200}
+        line = json.loads(logs.JsonFormatter().format(record))
+
+        self.assertEqual(line['msg'], 'hello world')
+        self.assertEqual(line['request_id'], 'abc')
+        self.assertEqual(line['status'], 200)
+
+
+class ProfilingTestCase(unittest.TestCase):
+    """GET /profile and the X-Profile header"""
+
+    ADMIN = {'permissions': ['profile:worker']}
+    THREADED = {'wsgi.multithread': True}   # What gunicorn --threads sets
+
+    def setUp(self):
+        self.app = create_app({
+            "DATABASE_URL": "sqlite://",
+            "RATELIMIT_ENABLED": False,
+            "PROFILING_ENABLED": True,
+        })
+        self.client = self.app.test_client
+        self.headers = {'Authorization': 'Bearer token'}
+        with self.app.app_context():
+            db.create_all()
+
+    def test_disabled_by_default(self):
+        """Without PROFILING_ENABLED there is no endpoint and the header is ignored."""
+        client = create_app({"DATABASE_URL": "sqlite://", "RATELIMIT_ENABLED": False}).test_client()
+        self.assertEqual(client.get('/profile').status_code, 404)
+        self.assertNotIn('X-Profile-Status', client.get('/', headers={'X-Profile': 'pstats'}).headers)
+
+    def test_needs_permission(self):
+        """Profiling needs a token with profile:worker."""
+        self.assertEqual(self.client().get('/profile?seconds=0.1').status_code, 401)
+        with mock.patch('profiler.verify_decode_jwt', return_value={'permissions': ['edit:policy']}):
+            res = self.client().get('/policies', headers=dict(self.headers, **{'X-Profile': 'pstats'}))
+        self.assertEqual(res.status_code, 403)
+
+    def test_profile_worker(self):
+        """Samples other threads and returns collapsed stacks."""
+        stop = threading.Event()
+        busy = threading.Thread(target=lambda: stop.wait(5))
+        busy.start()
+        try:
+            with mock.patch('profiler.verify_decode_jwt', return_value=self.ADMIN):
+                res = self.client().get('/profile?seconds=0.2', headers=self.headers, environ_overrides=self.THREADED)
+        finally:
+            stop.set()
+            busy.join()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertGreater(int(res.headers['X-Profile-Samples']), 0)
+        self.assertIn('threading.wait', res.get_data(as_text=True))
+        for line in res.get_data(as_text=True).splitlines():
+            stack, count = line.rsplit(' ', 1)
+            self.assertGreater(int(count), 0)
+
+    def test_profile_worker_conflicts(self):
+        """A second profile while one runs is a 409, and single threaded workers get a 503."""
+        with mock.patch('profiler.verify_decode_jwt', return_value=self.ADMIN):
+            self.assertEqual(self.client().get('/profile?seconds=0.1', headers=self.headers).status_code, 503)
+
+            first = threading.Thread(target=lambda: self.client().get(
+                '/profile?seconds=0.5', headers=self.headers, environ_overrides=self.THREADED))
+            first.start()
+            time.sleep(0.1)
+            res = self.client().get('/profile?seconds=0.1', headers=self.headers, environ_overrides=self.THREADED)
+            first.join()
+
+        self.assertEqual(res.status_code, 409)
+        self.assertEqual(res.get_json()['error'], 409)
+
+    def test_profile_request(self):
+        """X-Profile returns the request's profile instead of its response."""
+        headers = dict(self.headers, **{'X-Profile': 'pstats'})
+        with mock.patch('profiler.verify_decode_jwt', return_value=self.ADMIN):
+            res = self.client().get('/policies', headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['X-Profile-Status'], '200')
+        self.assertIn('get_policies', res.get_data(as_text=True))
+
+    def test_collapse(self):
+        """A frame's stack is outermost first."""
+        def inner():
+            return profiler.collapse(sys._getframe())
+
+        self.assertTrue(inner().endswith('test_app.test_collapse;test_app.inner'))
+
+
+class CountingKeyProvider:
+    """Keys from memory, counting downloads"""
+
+    def __init__(self, jwks):
+        self.jwks = jwks
+        self.fetches = 0
+
+    def fetch_jwks(self):
+        self.fetches += 1
+        return self.jwks
+
+
+class AuthTestCase(unittest.TestCase):
+    """Authorization header parsing, the token verifier, and locally minted tokens"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.private_pem, cls.jwks = tokens.generate_keys()
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        jwks_path = os.path.join(self.tmp.name, 'jwks.json')
+        with open(jwks_path, 'w') as jwks_file:
+            json.dump(self.jwks, jwks_file)
+
+        self.app = create_app({
+            "DATABASE_URL": "sqlite://",
+            "RATELIMIT_ENABLED": False,
+            "AUTH_JWKS_FILE": jwks_path,
+        })
+        self.client = self.app.test_client
+        with self.app.app_context():
+            db.create_all()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def verifier(self, **kwargs):
+        return auth.JWTVerifier(CountingKeyProvider(self.jwks), ['RS256'], 'roboterms-api',
+                                auth.LOCAL_ISSUER, **kwargs)
+
+    def token(self, permissions=('post:company',), **claims):
+        return tokens.mint_token(self.private_pem, permissions, **claims)
+
+    def test_malformed_headers(self):
+        """Blank, one word, and oversized headers are a 401, never a 500."""
+        for header in ['   ', 'Bearer', 'Bearer a b', 'Basic abc', 'Bearer ' + 'a' * 10000]:
+            res = self.client().delete('/company/1', headers={'Authorization': header})
+            self.assertEqual(res.status_code, 401, header[:20])
+
+    def test_oversized_header(self):
+        """An oversized header says it's too long, not that it doesn't start with Bearer."""
+        res = self.client().delete('/company/1', headers={'Authorization': 'Bearer ' + 'a' * 10000})
+
+        self.assertEqual(res.get_json()['code'], 'invalid_auth_header')
+        self.assertIn('too long', res.get_json()['description'])
+
+    def test_verify(self):
+        """Good tokens verify, expired and wrong audience tokens don't."""
+        verifier = self.verifier()
+        self.assertEqual(verifier.verify(self.token())['sub'], 'local|tester')
+
+        with self.assertRaises(auth.AuthError) as expired:
+            verifier.verify(self.token(exp=int(time.time()) - 60))
+        self.assertEqual(expired.exception.error['code'], 'token_expired')
+        with self.assertRaises(auth.AuthError) as audience:
+            verifier.verify(self.token(aud='someone-else'))
+        self.assertEqual(audience.exception.error['code'], 'invalid_claims')
+
+    def test_keys_cached(self):
+        """Keys are downloaded once, and again for an unknown kid at most every refresh_interval."""
+        verifier = self.verifier(refresh_interval=60)
+        for _ in range(3):
+            verifier.verify(self.token())
+        self.assertEqual(verifier.key_provider.fetches, 1)
+
+        verifier._fetched_at -= 120     # Keys downloaded two minutes ago
+        other_pem, _ = tokens.generate_keys(1024)
+        for _ in range(3):
+            with self.assertRaises(auth.AuthError):
+                verifier.verify(tokens.mint_token(other_pem, ['post:company']))
+        self.assertEqual(verifier.key_provider.fetches, 2)
+
+    def test_local_tokens(self):
+        """With AUTH_JWKS_FILE, minted tokens work end to end with their role's permissions."""
+        client = {'Authorization': 'Bearer ' + self.token(tokens.ROLES['client'])}
+        admin = {'Authorization': 'Bearer ' + self.token(tokens.ROLES['admin'])}
+
+        res = self.client().post('/company', json={"name": "Local Co", "website": "local.com"}, headers=client)
+        self.assertEqual(res.status_code, 200)
+        res = self.client().delete(f"/company/{res.get_json()['id']}", headers=admin)
+        self.assertEqual(res.status_code, 403)
+
+    def test_token_command_without_auth_settings(self):
+        """manage.py token warns instead of failing when no auth is configured yet."""
+        key_path = os.path.join(self.tmp.name, 'key.pem')
+        with open(key_path, 'w') as key_file:
+            key_file.write(self.private_pem)
+        env = {name: value for name, value in os.environ.items()
+               if name not in ('AUTH0_DOMAIN', 'AUTH_JWKS_FILE', 'API_AUDIENCE', 'ALGORITHMS', 'AUTH_ISSUER')}
+        env['DATABASE_URL'] = 'sqlite://'
+
+        result = subprocess.run([sys.executable, 'manage.py', 'token', '--role', 'client', '-k', key_path], env=env,
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn('WARNING: AUTH_JWKS_FILE is not set', result.stderr)
+        self.assertEqual(self.verifier().verify(result.stdout.strip())['sub'], 'local|tester')
+
+
+class ChangesTestCase(DatabaseTestCase):
+    """The change log and GET /changes"""
+
+    PAYLOAD = {'sub': 'test|1', 'permissions': ['post:company', 'delete:company', 'edit:policy']}
+    test_config = {"RATELIMIT_ENABLED": False, "CHANGES_POLL_INTERVAL": 0.05}
+    push_app_context = False
+
+    def setUp(self):
+        super().setUp()
+        self.headers = {'Authorization': 'Bearer token'}
+        with self.app.app_context():
+            pop_policies()
+
+        patcher = mock.patch('auth.verify_decode_jwt', return_value=self.PAYLOAD)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post_company(self, name):
+        res = self.client().post('/company', json={"name": name, "website": name.lower() + ".com"},
+                                 headers=self.headers)
+        return res.get_json()['id']
+
+    def test_changes_in_order(self):
+        """Creates, updates and deletes show up oldest first with their data."""
+        co_id = self.post_company("Alpha")
+        self.client().patch('/policy/1', json={"name": "Terms"}, headers=self.headers)
+        self.client().delete(f'/company/{co_id}', headers=self.headers)
+
+        data = self.client().get('/changes').get_json()
+        actions = [(change['entity'], change['id'], change['action']) for change in data['changes']]
+        self.assertEqual(actions, [('company', co_id, 'create'), ('policy', 1, 'update'),
+                                   ('company', co_id, 'delete')])
+        self.assertEqual(data['changes'][0]['data']['name'], "Alpha")
+        self.assertEqual(data['changes'][1]['data']['name'], "Terms")
+        self.assertIsNone(data['changes'][2]['data'])
+        self.assertEqual(data['cursor'], data['changes'][-1]['cursor'])
+
+    def test_purge_clears_earlier_data(self):
+        """Deleting leaves the log alone, purging clears the company's details from it."""
+        gone = self.post_company("Alpha")
+        self.post_company("Beta")
+        self.client().delete(f'/company/{gone}', headers=self.headers)
+
+        def names():
+            changes = self.client().get('/changes').get_json()['changes']
+            return [change['data'] and change['data']['name'] for change in changes]
+
+        self.assertEqual(names(), ["Alpha", "Beta", None])
+        with self.app.app_context():
+            list(purge_deleted())
+        self.assertEqual(names(), [None, "Beta", None])
+
+    def test_bad_parameters(self):
+        """Malformed or out of range parameters are a 400, not a 500 or the default."""
+        for query in ['since=nope', 'since=%D9%A1', 'since=' + '9' * 30, 'since=-1',
+                      'limit=abc', 'limit=0', 'limit=5000', 'wait=soon', 'wait=nan', 'wait=999']:
+            self.assertEqual(self.client().get('/changes?' + query).status_code, 400, query)
+        self.assertEqual(self.client().get('/changes?since=' + '9' * 18).status_code, 200)
+
+    def test_resume_from_cursor(self):
+        """A cursor picks up where the last page left off."""
+        for name in ["Alpha", "Beta", "Gamma"]:
+            self.post_company(name)
+        self.client().post('/company', json={"name": "Alpha", "website": "again.com"}, headers=self.headers)
+
+        first = self.client().get('/changes?limit=2').get_json()
+        self.assertTrue(first['has_more'])
+        rest = self.client().get(f"/changes?since={first['cursor']}&limit=2").get_json()
+
+        names = [change['data']['name'] for change in first['changes'] + rest['changes']]
+        self.assertEqual(names, ["Alpha", "Beta", "Gamma"])     # The failed duplicate isn't there
+        self.assertFalse(rest['has_more'])
+
+    def test_long_poll(self):
+        """A caught up client waits, and gets the next change as soon as it's committed."""
+        cursor = self.client().get('/changes').get_json()['cursor']
+        writer = threading.Timer(0.2, self.post_company, args=["Late Co"])
+        writer.start()
+
+        started = time.monotonic()
+        data = self.client().get(f'/changes?since={cursor}&wait=10').get_json()
+        writer.join()
+
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual([change['data']['name'] for change in data['changes']], ["Late Co"])
+
+        # Nothing new: returns empty after the wait, with the same cursor
+        data = self.client().get(f"/changes?since={data['cursor']}&wait=0.1").get_json()
+        self.assertEqual(data['changes'], [])
+
+
+class TenantTestCase(DatabaseTestCase):
+    """Tenant scoped companies and policy catalogs"""
+
+    PAYLOADS = {
+        'default': {'sub': 'test|1', 'permissions': ['post:company', 'delete:company', 'edit:policy']},
+        'acme': {'sub': 'test|2', 'org_id': 'acme', 'permissions': ['post:company', 'delete:company', 'edit:policy']},
+    }
+
+    test_config = {"RATELIMIT_ENABLED": False, "CATALOG_MAX_AGE": 60}
+    push_app_context = False
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            pop_policies()
+            pop_policies('acme')
+
+        patcher = mock.patch('auth.verify_decode_jwt', side_effect=lambda token: self.PAYLOADS[token])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def as_tenant(self, tenant_id):
+        return {'Authorization': 'Bearer ' + tenant_id}
+
+    def policy_ids(self, tenant_id):
+        policies = self.client().get(f'/policies?tenant={tenant_id}').get_json()['policies']
+        return {policy['name']: policy['id'] for policy in policies}
+
+    def test_companies_per_tenant(self):
+        """Names only have to be unique within a tenant, and tenants only see their own."""
+        company = {"name": "Green Cola, Inc.", "website": "gcola.com"}
+        default_id = self.client().post('/company', json=company, headers=self.as_tenant('default')).get_json()['id']
+        self.client().post('/company', json=company, headers=self.as_tenant('acme'))
+        res = self.client().post('/company', json=company, headers=self.as_tenant('acme'))
+        self.assertEqual(res.status_code, 422)
+
+        self.assertEqual(len(self.client().get('/companies').get_json()['companies']), 1)
+        self.assertEqual(len(self.client().get('/companies?tenant=acme').get_json()['companies']), 1)
+        self.assertEqual(self.client().get('/companies?tenant=no%20spaces').status_code, 400)
+
+        res = self.client().delete(f'/company/{default_id}', headers=self.as_tenant('acme'))
+        self.assertEqual(res.status_code, 404)
+
+    def test_edit_swaps_catalog(self):
+        """An edit changes only that tenant's catalog, and renders see it right away."""
+        acme_tos = self.policy_ids('acme')["Terms of Service"]
+        default_tos = self.policy_ids('default')["Terms of Service"]
+        co_id = self.client().post('/company', json={"name": "Acme", "website": "acme.com"},
+                                   headers=self.as_tenant('acme')).get_json()['id']
+        before = self.app.extensions['catalogs'].get('acme')
+
+        res = self.client().patch(f'/policy/{default_tos}', json={"body": "Nope"}, headers=self.as_tenant('acme'))
+        self.assertEqual(res.status_code, 404)
+        res = self.client().patch(f'/policy/{acme_tos}', json={"body": "Acme terms for {COMPANY}"},
+                                  headers=self.as_tenant('acme'))
+        self.assertEqual(res.status_code, 200)
+
+        self.assertIsNot(self.app.extensions['catalogs'].get('acme'), before)
+        self.assertNotIn("Acme terms", before.get(acme_tos).body)     # Old snapshot left as it was
+        res = self.client().get(f'/rendered_policy/{co_id}/{acme_tos}?format=text')
+        self.assertEqual(res.get_data(as_text=True), "Acme terms for Acme\n")
+        res = self.client().get(f'/rendered_policy/{co_id}/{default_tos}')
+        self.assertEqual(res.status_code, 404)  # Not in the company's tenant's catalog
+
+    def test_renders_skip_catalog_queries(self):
+        """Once a tenant's catalog is loaded, renders only query the company."""
+        co_id = self.client().post('/company', json={"name": "Acme", "website": "acme.com"},
+                                   headers=self.as_tenant('acme')).get_json()['id']
+        policy_ids = list(self.policy_ids('acme').values())
+
+        statements = []
+        with self.app.app_context():
+            engine = db.get_engine(self.app)
+            listener = lambda conn, cursor, statement, *args: statements.append(statement)
+            event.listen(engine, 'before_cursor_execute', listener)
+            try:
+                for policy_id in policy_ids:
+                    self.assertEqual(self.client().get(f'/rendered_policy/{co_id}/{policy_id}').status_code, 200)
+            finally:
+                event.remove(engine, 'before_cursor_execute', listener)
+
+        self.assertTrue(statements)
+        self.assertFalse([statement for statement in statements if 'FROM "Policy"' in statement])
+
+    def test_catalog_store(self):
+        """Snapshots are reused until they're too old, and the least recently used go first."""
+        with self.app.app_context():
+            store = tenants.CatalogStore(max_age=60, max_tenants=1)
+            first = store.get('default')
+            self.assertIs(store.get('default'), first)
+            self.assertEqual(len(first.policies), 4)
+
+            store.get('acme')
+            self.assertEqual(list(store._catalogs), ['acme'])
+            self.assertIsNot(store.get('default'), first)   # Was evicted, loaded again
+
+    def test_unknown_tenants_not_cached(self):
+        """Made-up tenant ids get an empty catalog but can't evict real ones."""
+        with self.app.app_context():
+            store = tenants.CatalogStore(max_age=60, max_tenants=2)
+            store.get('default')
+            store.get('acme')
+            for number in range(5):
+                self.assertEqual(store.get(f'nobody{number}').policies, ())
+
+            self.assertEqual(list(store._catalogs), ['default', 'acme'])
+            self.assertEqual(set(store._locks), {'default', 'acme'})
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
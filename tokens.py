@@ -0,0 +1,68 @@
+import json
+import time
+import hashlib
+
+from auth import LOCAL_ISSUER
+
+# Locally signed tokens, for testing and for running without Auth0
+#
+#   python manage.py keygen                      writes local_auth_key.pem and local_jwks.json
+#   export AUTH_JWKS_FILE=local_jwks.json        the app now trusts those keys instead of Auth0
+#   python manage.py token --role client         prints a token with the client permissions
+#
+# The tokens look like Auth0's (RS256, kid header, aud/iss/exp/permissions
+# claims), so they go through exactly the same verification.
+
+# Permissions of the roles set up on Auth0 (see README, Roles and Permissions)
+ROLES = {
+    'client': ['post:company', 'delete:company'],
+    'admin': ['edit:policy'],
+}
+
+
+def _b64(raw):
+    from jose.utils import base64url_encode
+    return base64url_encode(raw).decode()
+
+
+def _b64_int(number):
+    return _b64(number.to_bytes((number.bit_length() + 7) // 8, 'big'))
+
+
+def public_jwk(private_key):
+    '''
+    The JWKS entry for the public half of a pycryptodome RSA key.  The kid is the
+    key's RFC 7638 thumbprint, so the same key always gets the same kid.
+    '''
+    jwk = {'e': _b64_int(private_key.e), 'kty': 'RSA', 'n': _b64_int(private_key.n)}
+    kid = _b64(hashlib.sha256(json.dumps(jwk, sort_keys=True, separators=(',', ':')).encode()).digest())
+    return dict(jwk, kid=kid, use='sig', alg='RS256')
+
+
+def generate_keys(bits=2048):
+    '''Returns (private key PEM, JWKS dict) for a new RSA key'''
+    from Crypto.PublicKey import RSA
+    private_key = RSA.generate(bits)
+    return private_key.exportKey('PEM').decode(), {'keys': [public_jwk(private_key)]}
+
+
+def mint_token(private_pem, permissions, sub='local|tester', audience='roboterms-api',
+               issuer=LOCAL_ISSUER, expires_in=24 * 3600, **claims):
+    '''
+    mint_token(pem, ROLES['client'])
+    Returns an RS256 token signed with the private key, valid for expires_in seconds
+    '''
+    from Crypto.PublicKey import RSA
+    from jose import jwt
+
+    now = int(time.time())
+    claims = dict({
+        'iss': issuer,
+        'aud': audience,
+        'sub': sub,
+        'iat': now,
+        'exp': now + int(expires_in),
+        'permissions': list(permissions),
+    }, **claims)
+    kid = public_jwk(RSA.importKey(private_pem))['kid']
+    return jwt.encode(claims, private_pem, algorithm='RS256', headers={'kid': kid})
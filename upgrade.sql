@@ -0,0 +1,70 @@
+--
+-- Upgrades a database made from the original roboterms_test.sql to the
+-- current schema (what roboterms_test.sql and db.create_all() make now):
+--
+--   soft delete       "Company".deleted_at, live-only unique name/website
+--   company details   "Company".contact_email, jurisdiction, effective_date
+--   change log        "Change" table for GET /changes
+--   tenants           tenant_id on every table, existing rows go to 'default'
+--
+-- Safe to run more than once.  Everything is in one transaction, so it either
+-- all happens or none of it does.
+--
+--   psql -U postgres roboterms < upgrade.sql
+--
+-- SQLite databases are only for local development, recreate those with
+--   python manage.py seed --reset --mock
+--
+
+BEGIN;
+
+--
+-- Company: new columns
+--
+
+ALTER TABLE public."Company" ADD COLUMN IF NOT EXISTS contact_email character varying(120);
+ALTER TABLE public."Company" ADD COLUMN IF NOT EXISTS jurisdiction character varying(80);
+ALTER TABLE public."Company" ADD COLUMN IF NOT EXISTS effective_date date;
+ALTER TABLE public."Company" ADD COLUMN IF NOT EXISTS deleted_at timestamp without time zone;
+ALTER TABLE public."Company" ADD COLUMN IF NOT EXISTS tenant_id character varying(64) DEFAULT 'default'::character varying NOT NULL;
+
+--
+-- Company: names and websites are unique among a tenant's live companies only,
+-- so the table-wide UNIQUE constraints are replaced by partial indexes
+--
+
+ALTER TABLE ONLY public."Company" DROP CONSTRAINT IF EXISTS "Company_name_key";
+ALTER TABLE ONLY public."Company" DROP CONSTRAINT IF EXISTS "Company_website_key";
+
+CREATE INDEX IF NOT EXISTS ix_company_live ON public."Company" USING btree (tenant_id, id) WHERE (deleted_at IS NULL);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_company_name_live ON public."Company" USING btree (tenant_id, name) WHERE (deleted_at IS NULL);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_company_website_live ON public."Company" USING btree (tenant_id, website) WHERE (deleted_at IS NULL);
+
+--
+-- Policy: each tenant has its own catalog, names are unique within it
+--
+
+ALTER TABLE public."Policy" ADD COLUMN IF NOT EXISTS tenant_id character varying(64) DEFAULT 'default'::character varying NOT NULL;
+
+ALTER TABLE ONLY public."Policy" DROP CONSTRAINT IF EXISTS "Policy_name_key";
+
+CREATE UNIQUE INDEX IF NOT EXISTS ix_policy_tenant_name ON public."Policy" USING btree (tenant_id, name);
+
+--
+-- Change: the change log (see record_change() in models.py)
+--
+
+CREATE TABLE IF NOT EXISTS public."Change" (
+    id serial PRIMARY KEY,
+    entity character varying(20) NOT NULL,
+    entity_id integer NOT NULL,
+    action character varying(10) NOT NULL,
+    data text,
+    created_at timestamp without time zone NOT NULL,
+    tenant_id character varying(64) DEFAULT 'default'::character varying NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS ix_change_tenant ON public."Change" USING btree (tenant_id, id);
+CREATE INDEX IF NOT EXISTS ix_change_entity ON public."Change" USING btree (entity, entity_id);
+
+COMMIT;